@@ -0,0 +1,66 @@
+import threading
+import time
+from typing import *
+
+from portfolio import Portfolio
+from utils import get_balance
+
+RECONCILE_EVERY = 25  # bets between reconciliations with the server
+RECONCILE_INTERVAL = 60 * 5  # seconds between reconciliations with the server
+DRIFT_TOLERANCE = 1.0  # M, report differences between local and server balance above this
+
+
+class Account:
+    """In-process balance and positions of the user, updated locally from the responses of our own bets.
+
+    Replaces a `get_balance` (and bet download) round trip after every bet. The local state is reconciled with the server
+    every `reconcile_every` bets or `reconcile_interval` seconds, and right away after a bet response that couldn't be applied.
+    """
+
+    def __init__(self, user_id, reconcile_every=RECONCILE_EVERY, reconcile_interval=RECONCILE_INTERVAL, verbose=False):
+        self.user_id = user_id
+        self.reconcile_every = reconcile_every
+        self.reconcile_interval = reconcile_interval
+        self.verbose = verbose
+        self._lock = threading.RLock()
+        self._balance = 0.0
+        self.portfolio: Optional[Portfolio] = None
+        self.reconcile()
+
+    @property
+    def balance(self) -> float:
+        return self._balance
+
+    def reconcile(self):
+        """Fetches balance and positions from the server (bets via the incremental ledger)."""
+        with self._lock:
+            balance = get_balance()
+            if self.portfolio is not None and abs(balance - self._balance) > DRIFT_TOLERANCE:
+                print(f"Balance drifted: {self._balance:.0f} M (local) vs. {balance:.0f} M (server). Using the server balance.")
+            self._balance = balance
+            self.portfolio = Portfolio.from_user(self.user_id, verbose=self.verbose)
+            self._bets_since_reconcile = 0
+            self._last_reconcile = time.monotonic()
+            self._stale = False
+
+    def maybe_reconcile(self):
+        """Reconciles if the local state is stale, or enough bets or time have passed since the last reconciliation."""
+        with self._lock:
+            if (
+                self._stale
+                or self._bets_since_reconcile >= self.reconcile_every
+                or time.monotonic() - self._last_reconcile >= self.reconcile_interval
+            ):
+                self.reconcile()
+
+    def apply_bet(self, contract_id, outcome, bet: Optional[Dict[str, Any]]):
+        """Books a bet response (as filled): pays its amount and adds its shares.
+        Manifold redeems YES/NO share pairs for M1 each right away, so buying against a position refunds part of the amount.
+        """
+        with self._lock:
+            if bet is None or bet.get("amount") is None or bet.get("shares") is None:
+                self._stale = True
+                return
+            redeemed = self.portfolio.apply_bet(contract_id, outcome, bet["shares"])
+            self._balance += redeemed - bet["amount"]
+            self._bets_since_reconcile += 1
@@ -2,29 +2,33 @@ import argparse
 import math
 import random
 import time
+from concurrent.futures import Future
+from typing import *
 
-from tqdm import tqdm
-
+from account import Account
+from cpmm import pool_from_market
 from db import DB
-from kelly import kelly_manifold
-from manifoldpy import api
+from decisions import bet_size
+from orders import Order, OrderExecutor, OrderResult
+from pipeline import run_pipeline
+from resolved import get_resolved_markets
+from scraping import get_nba_table, get_nhl_table, get_soup, get_urls_for_mkt_fn, prefetch_pages
+from transport import PooledAPIWrapper
 from utils import (
     append_resolved_market,
     binary_outcome,
     compress_sentence,
     filter_question,
-    get_balance,
     get_market_from_manifold,
+    get_markets_bulk,
     get_position_value,
-    get_shares,
+    get_user_bets_custom,
     is_liquidating_bet,
     limit_price,
     limit_price_is_between_ps,
     load_config,
-    make_bet_and_cancel,
     minimal_question,
     now,
-    read_resolved_markets,
     should_bet_position,
     should_bet_probabilities,
 )
@@ -32,114 +36,203 @@ from utils import (
 API_KEY, USER_ID = load_config()
 
 
+def print_cache_info():
+    for fn in (get_market_from_manifold, get_user_bets_custom, get_soup, get_nba_table, get_nhl_table):
+        info = fn.cache_info()
+        hit_rate = info.hits / max(1, info.hits + info.misses)
+        print(
+            f"Cache {fn.__name__:>24}: {hit_rate*100:5.1f} % hits ({info.hits} hits, {info.misses} misses, "
+            f"{info.evictions} evictions, size {info.currsize}/{info.maxsize})"
+        )
+
+
+def evaluate_market(mkt_id, portfolio, margin, tail, q_filter, max_shares, liquidation, fast, verbose) -> Optional[Dict[str, Any]]:
+    """Fetches the market and its true probability and looks up our position in `portfolio`.
+    Returns everything needed to place a bet or None if there is nothing to bet on.
+    """
+    mkt_fn = DB[mkt_id]["mkt_fn"]
+    if mkt_fn is None:
+        print(f"Market {mkt_id} has no mkt_fn. Skipping.")
+        print("-" * 10)
+        return None
+    mkt = get_market_from_manifold(mkt_id)
+    question = mkt.question
+    if q_filter and not filter_question(question, q_filter):  # in verbose mode, still filter
+        return None
+
+    compressed_question = compress_sentence(question) if fast else minimal_question(question)
+
+    if mkt.isResolved or mkt.closeTime < now():
+        print(f"Market {mkt_id} ({compressed_question}) closed/resolved. Skipping and adding to resolved list.")
+        append_resolved_market(mkt_id, mkt.closeTime, mkt.resolutionTime)
+        print("-" * 10)
+        return None
+
+    mkt_p = mkt.probability
+    try:
+        true_p = mkt_fn()
+    except Exception as e:
+        print(f"Error in mkt_fn for {mkt_id} ({compressed_question}): {e}")
+        return None
+    diff = mkt_p - true_p
+    o = binary_outcome(mkt_p, true_p)
+    individual_mkt_shares, group_shares, has_group = portfolio.get_shares(mkt_id=mkt_id, database=DB)
+    is_liq_bet = is_liquidating_bet(binary_outcome=o, shares=individual_mkt_shares)
+    if liquidation and not is_liq_bet and not verbose:
+        return None  # skip non-liquidation bets
+    l = limit_price(mkt_p, true_p, tail)
+    if abs(mkt_p - l) < 0.001 and not verbose:
+        return None
+    if not limit_price_is_between_ps(mkt_p, true_p, l) and not verbose:
+        return None
+
+    if should_bet_probabilities(mkt_p, true_p, margin, tail) or is_liq_bet or verbose:
+        if not should_bet_position(binary_outcome=o, shares=group_shares, max_shares=max_shares) and not verbose:
+            return None
+        return dict(
+            mkt_id=mkt_id,
+            compressed_question=compressed_question,
+            mkt_p=mkt_p,
+            true_p=true_p,
+            diff=diff,
+            o=o,
+            l=l,
+            individual_mkt_shares=individual_mkt_shares,
+            group_shares=group_shares,
+            has_group=has_group,
+            is_liq_bet=is_liq_bet,
+            pool=pool_from_market(mkt),
+        )
+    return None
+
+
+def place_bet(
+    candidate, executor, amount, min_bet, use_kelly, kelly_scale, verbose, to_target=False, max_shares=1_000
+) -> Optional["Future[OrderResult]"]:
+    """Sizes the bet for a candidate from `evaluate_market` and submits it to `executor`.
+    With `to_target`, the bet is the amount that moves the market exactly to the limit price (from its pool),
+    bounded by `max_shares` and the Kelly amount (scaled by `kelly_scale`, also without `use_kelly`), instead of `amount`.
+    Returns the future of the order's result or None if the bet was skipped.
+    """
+    mkt_id, compressed_question = candidate["mkt_id"], candidate["compressed_question"]
+    mkt_p, true_p, diff, o, l = candidate["mkt_p"], candidate["true_p"], candidate["diff"], candidate["o"], candidate["l"]
+    individual_mkt_shares, group_shares, has_group = candidate["individual_mkt_shares"], candidate["group_shares"], candidate["has_group"]
+    ev_true = get_position_value(individual_mkt_shares, true_p)
+    ev_mkt = get_position_value(individual_mkt_shares, mkt_p)
+    print(f"q: {compressed_question:>44} | p_mkt: {mkt_p*100:6.1f} % | p_tru: {true_p*100:6.1f} % | diff: {diff*100:6.1f} %")
+    shares_repr = f"{individual_mkt_shares:5.0f} shares ({group_shares:5.0f} group shares)" if has_group else f"{group_shares:16.0f} shares"
+    print(f"pos: {shares_repr:>42} | ev_mkt: {ev_mkt:5.0f} M | ev_tru: {ev_true:5.0f} M | diff: {ev_true-ev_mkt:6.0f} M\n")
+    # sized from the booked balance: the orders still in flight only hold their amounts until they are filled or cancelled
+    balance = executor.account.balance
+    bet_amount = bet_size(
+        candidate["pool"], mkt_p, true_p, o, l, group_shares, balance, amount, use_kelly, kelly_scale, to_target, max_shares
+    )
+    if bet_amount < min_bet and not verbose:
+        print(f"Bet amount is {bet_amount} < {min_bet} M (min bet). Skipping.")
+        print("-" * 10)
+        return None
+    if verbose:
+        return None
+    if bet_amount > executor.available_balance():  # the orders in flight hold the rest of the balance
+        executor.wait()
+        bet_amount = min(bet_amount, math.floor(executor.available_balance()))
+        if bet_amount < min_bet:
+            print(f"Bet amount is {bet_amount} < {min_bet} M (min bet) after the orders in flight. Skipping.")
+            print("-" * 10)
+            return None
+    return executor.submit(Order(contract_id=mkt_id, outcome=o, amount=bet_amount, limit_p=l, mkt_p=mkt_p))
+
+
 def make_all_bets(
-    wrapper, amount, min_bet, margin, tail, dry_run, use_kelly, kelly_scale, sleep, q_filter, max_shares, liquidation, fast, verbose
+    wrapper,
+    amount,
+    min_bet,
+    margin,
+    tail,
+    dry_run,
+    use_kelly,
+    kelly_scale,
+    sleep,
+    q_filter,
+    max_shares,
+    liquidation,
+    fast,
+    verbose,
+    concurrency=1,
+    account=None,
+    order_concurrency=1,
+    to_target=False,
 ) -> bool:
+    """Evaluates the markets concurrently (`concurrency` at a time) and submits the bets in order,
+    placing up to `order_concurrency` of them at a time.
+    """
     bets_made = 0
     print("========================================")
 
-    balance = get_balance()
-    print(f"Balance: {balance:.0f} M")
-    if balance < 1 and not dry_run and not verbose:
+    if account is None:
+        account = Account(USER_ID, verbose=verbose)
+    account.maybe_reconcile()
+    print(f"Balance: {account.balance:.0f} M")
+    if account.balance < 1 and not dry_run and not verbose:
         print("========================================")
         print("Balance too low. Return.")
         return False, bets_made
 
     mkt_ids = list(DB.keys())
-    resolved_markets = read_resolved_markets()
+    resolved_markets = get_resolved_markets()
     mkt_ids = [m for m in mkt_ids if m not in resolved_markets]
     random.shuffle(mkt_ids)
     print(f"Found {len(mkt_ids)} markets.")
+    mkt_ids = [m for m in mkt_ids if random.random() <= DB[m]["bet_p"]]
+    # download all 538 pages up front (concurrently) instead of stalling on the first market that needs each page
+    prefetch_pages(set().union(*(get_urls_for_mkt_fn(DB[m]["mkt_fn"]) for m in mkt_ids if DB[m]["mkt_fn"] is not None)), verbose=verbose)
+    get_markets_bulk((m for m in mkt_ids if DB[m]["mkt_fn"] is not None), verbose=verbose)
     print("-" * 10)
 
-    for mkt_id in tqdm(mkt_ids):
+    def evaluate(mkt_id):
         try:
-            bet_p = DB[mkt_id]["bet_p"]
-            random_number = random.random()
-            if random_number > bet_p:
-                continue
-            mkt_fn = DB[mkt_id]["mkt_fn"]
-            if mkt_fn is None:
-                print(f"Market {mkt_id} has no mkt_fn. Skipping.")
-                print("-" * 10)
-                continue
-            mkt = get_market_from_manifold(mkt_id)
-            question = mkt.question
-            if q_filter and not filter_question(question, q_filter):  # in verbose mode, still filter
-                continue
-
-            compressed_question = compress_sentence(question) if fast else minimal_question(question)
-
-            if mkt.isResolved or mkt.closeTime < now():
-                print(f"Market {mkt_id} ({compressed_question}) closed/resolved. Skipping and adding to resolved list.")
-                append_resolved_market(mkt_id)
-                print("-" * 10)
-                continue
-
-            mkt_p = mkt.probability
-            try:
-                true_p = mkt_fn()
-            except Exception as e:
-                print(f"Error in mkt_fn for {mkt_id} ({compressed_question}): {e}")
-                continue
-            diff = mkt_p - true_p
-            o = binary_outcome(mkt_p, true_p)
-            individual_mkt_shares, group_shares, has_group = get_shares(mkt_id=mkt_id, database=DB, user_id=USER_ID)
-            is_liq_bet = is_liquidating_bet(binary_outcome=o, shares=individual_mkt_shares)
-            if liquidation and not is_liq_bet and not verbose:
-                continue  # skip non-liquidation bets
-            l = limit_price(mkt_p, true_p, tail)
-            if abs(mkt_p - l) < 0.001 and not verbose:
-                continue
-            if not limit_price_is_between_ps(mkt_p, true_p, l) and not verbose:
-                continue
-
-            if should_bet_probabilities(mkt_p, true_p, margin, tail) or is_liq_bet or verbose:
-                if not should_bet_position(binary_outcome=o, shares=group_shares, max_shares=max_shares) and not verbose:
-                    continue
-                ev_true = get_position_value(individual_mkt_shares, true_p)
-                ev_mkt = get_position_value(individual_mkt_shares, mkt_p)
-                print(f"q: {compressed_question:>44} | p_mkt: {mkt_p*100:6.1f} % | p_tru: {true_p*100:6.1f} % | diff: {diff*100:6.1f} %")
-                shares_repr = (
-                    f"{individual_mkt_shares:5.0f} shares ({group_shares:5.0f} group shares)" if has_group else f"{group_shares:16.0f} shares"
-                )
-                print(f"pos: {shares_repr:>42} | ev_mkt: {ev_mkt:5.0f} M | ev_tru: {ev_true:5.0f} M | diff: {ev_true-ev_mkt:6.0f} M\n")
-                if use_kelly:
-                    f = kelly_manifold(mkt_p=mkt_p, true_p=true_p)
-                    print(f"Kelly fraction to bet: {f:.2f} (scale: {kelly_scale:.2f} --> {f*kelly_scale:.2f})")
-                    bet_amount = round(f * balance * kelly_scale)
-                else:
-                    bet_amount = min(amount, math.floor(balance))
-                if bet_amount < min_bet and not verbose:
-                    print(f"Bet amount is {bet_amount} < {min_bet} M (min bet). Skipping.")
-                    print("-" * 10)
-                    continue
-                if not verbose:
-                    success = make_bet_and_cancel(
-                        wrapper=wrapper,
-                        amount=bet_amount,
-                        contract_id=mkt_id,
-                        binary_outcome=o,
-                        limit_p=l,
-                        dry_run=dry_run,
-                    )
-                    if success:
-                        bets_made += 1
-                        balance = get_balance()
-                        print(f"New balance: {balance:.0f} M")
-                        if is_liq_bet and abs(individual_mkt_shares) > 10 and abs(diff) > 0.005:
-                            print(f"****Position is liquidating. Sell shares all the way to {true_p*100:.1f} %.****")
-                        if balance < 1:
-                            print("========================================")
-                            print("Balance too low. Return.")
-                            return False, bets_made
-                print("-" * 10)
-                if sleep > 0:
-                    time.sleep(sleep)
+            return evaluate_market(mkt_id, account.portfolio, margin, tail, q_filter, max_shares, liquidation, fast, verbose)
         except Exception as e:
             print(f"Error when processing market {mkt_id}: {e}")
             print("-" * 10)
-    return True, bets_made
+            return None
+
+    submitted = []
+
+    def submit(mkt_id, candidate):
+        if candidate is None:
+            return True
+        try:
+            future = place_bet(candidate, executor, amount, min_bet, use_kelly, kelly_scale, verbose, to_target, max_shares)
+            if future is None:
+                return True
+            submitted.append((candidate, future))
+            if account.balance < 1:  # booked fills only: the unfilled parts of the orders in flight are refunded
+                print("========================================")
+                print("Balance too low. Return.")
+                return False
+            print("-" * 10)
+            if sleep > 0:
+                time.sleep(sleep)
+        except Exception as e:
+            print(f"Error when processing market {mkt_id}: {e}")
+            print("-" * 10)
+        return True
+
+    with OrderExecutor(wrapper, account, database=DB, max_shares=max_shares, max_workers=order_concurrency, dry_run=dry_run) as executor:
+        finished = run_pipeline(mkt_ids, evaluate, submit, concurrency=concurrency)
+    for candidate, future in submitted:
+        result = future.result()
+        if result.error is not None:
+            print(f"No bet on market {candidate['mkt_id']} ({candidate['compressed_question']}): {result.error}")
+        if result.bet is None:
+            continue
+        bets_made += 1
+        true_p, diff, individual_mkt_shares = candidate["true_p"], candidate["diff"], candidate["individual_mkt_shares"]
+        if candidate["is_liq_bet"] and abs(individual_mkt_shares) > 10 and abs(diff) > 0.005:
+            print(f"****Position is liquidating in {candidate['compressed_question']}. Sell shares all the way to {true_p*100:.1f} %.****")
+    print(f"New balance: {account.balance:.0f} M")
+    return finished, bets_made
 
 
 def parse_args():
@@ -158,9 +251,17 @@ def parse_args():
     )
     parser.add_argument("-r", "--repeat", type=int, default=1, help="Number of times to repeat the betting. Default: 1.")
     parser.add_argument("-d", "--dry-run", action="store_true", help="Dry run mode (no actual bets).")
+    parser.add_argument(
+        "-tt",
+        "--to-target",
+        action="store_true",
+        help="Bet what moves each market to the limit price in one order (bounded by max shares and Kelly) instead of --amount.",
+    )
     parser.add_argument("-k", "--use-kelly", action="store_true", help="Use Kelly criterion instead of fixed amount.")
     parser.add_argument("-ks", "--kelly-scale", type=float, default=0.1, help="Kelly scale factor. Default: 0.1.")
-    parser.add_argument("-s", "--sleep", type=int, default=8, help="Sleep time in seconds between bets. Default: 8.")
+    parser.add_argument(
+        "-s", "--sleep", type=int, default=0, help="Extra sleep in seconds between bets (API calls are rate limited). Default: 0."
+    )
     parser.add_argument(
         "-f",
         "--filter",
@@ -171,6 +272,12 @@ def parse_args():
     parser.add_argument("-ms", "--max-shares", type=int, default=1_000, help="Maximum shares to hold in one market. Default: 1_000.")
     parser.add_argument("-l", "--liquidation", action="store_true", help="Make only liquidating bets.")
     parser.add_argument("-x", "--fast", action="store_true", help="Fast mode: skip markets with low volume.")
+    parser.add_argument(
+        "-c", "--concurrency", type=int, default=8, help="Number of markets to fetch and evaluate concurrently. Default: 8."
+    )
+    parser.add_argument(
+        "-oc", "--order-concurrency", type=int, default=4, help="Number of bets to place (and cancel) concurrently. Default: 4."
+    )
     parser.add_argument("-v", "--verbose", action="store_true", help="Verbose mode. Print also markets with no bet.")
     return parser.parse_args()
 
@@ -191,14 +298,20 @@ def main():
     liquidation = args.liquidation
     fast = args.fast
     verbose = args.verbose
+    concurrency = args.concurrency
+    order_concurrency = args.order_concurrency
+    to_target = args.to_target
 
     print(
         f"Settings: amount={amount} M, min_bet={min_bet} M, margin={margin*100} %, tail={tail*100} %, "
         f"repeat={repeat}, dry_run={dry_run}, use_kelly={use_kelly}, kelly_scale={kelly_scale}, sleep={sleep}, "
-        f"q_filter={q_filter}, max_shares={max_shares}, liquidation={liquidation}, fast={fast}, verbose={verbose}."
+        f"q_filter={q_filter}, max_shares={max_shares}, liquidation={liquidation}, fast={fast}, verbose={verbose}, "
+        f"concurrency={concurrency}, order_concurrency={order_concurrency}, "
+        f"to_target={to_target}."
     )
 
-    wrapper = api.APIWrapper(API_KEY)
+    wrapper = PooledAPIWrapper(API_KEY)
+    account = Account(USER_ID, verbose=verbose)  # balance and positions, kept up to date locally across repeats
 
     if use_kelly:
         print("Using Kelly criterion for bet amounts.")
@@ -220,8 +333,14 @@ def main():
             liquidation=liquidation,
             fast=fast,
             verbose=verbose,
+            concurrency=concurrency,
+            account=account,
+            order_concurrency=order_concurrency,
+            to_target=to_target,
         )
         print(f"Made {bets_made} bets.")
+        if verbose:
+            print_cache_info()
         if finished is False:  # balance too low
             return
 
@@ -2,16 +2,19 @@ import argparse
 import itertools as it
 import random
 import time
-from functools import partial
-from multiprocessing import Pool
 
+import numpy as np
 from tqdm import tqdm
 
+from account import Account
+from cpmm import amount_to_probability, pools_from_markets
 from db import DB, IDENTICAL_MARKETS
-from manifoldpy import api
+from orders import Order, OrderExecutor, is_filled
+from transport import PooledAPIWrapper
 from utils import *
 
 API_KEY, USER_ID = load_config()
+AMOUNT_TOLERANCE = 1e-6  # M, smaller amounts to a limit price are rounding errors (and would round up to a 1 M bet)
 
 # Idea:
 # Write a tool that takes groups of markets with identical outcome
@@ -37,28 +40,40 @@ def calc_bet_amount(base_amount: int, p: float, o: str) -> int:
     return round(base_amount * p_bet_successful)
 
 
+def amounts_to_limit(mkts, limit_ps) -> np.ndarray:
+    """Amounts that move each market exactly to its limit price, from its CPMM pool (inf without a pool).
+    Any more than that would not be filled anyway.
+    """
+    pools, has_pool = pools_from_markets(mkts)
+    amounts, _ = amount_to_probability(pools, limit_ps)
+    amounts = np.where(amounts < AMOUNT_TOLERANCE, 0.0, amounts)  # float noise of a market already at its limit
+    return np.where(has_pool, np.ceil(amounts), np.inf)
+
+
 def bet_on_group_simple(
-    group_name, group_markets, margin, wrapper, q_filter, amount, balance, min_bet, dry_run, sleep, verbose, is_complementary=False
+    group_name, group_markets, margin, executor, q_filter, amount, account, min_bet, sleep, verbose, is_complementary=False, unwind=False
 ):
     """Bets on a group of markets with identical or complementary outcomes.
     In case of complementary outcomes, we operate do the computation (of the limit price) in the probability space
     of market 1 and convert it to the complementary probability for betting.
+    Both legs are placed concurrently by `executor` (an `orders.OrderExecutor`) and booked in `account` (an `account.Account`).
+    With `unwind`, the filled leg is sold again if the other one doesn't fill.
     """
     already_printed = False
     mkt_id_1, mkt_id_2 = group_markets
     mkt_1, mkt_2 = get_market_from_manifold(mkt_id_1), get_market_from_manifold(mkt_id_2)
 
     now_mani = now()
-    resolved_markets = read_resolved_markets()
+    resolved_markets = get_resolved_markets()
     if mkt_1.id in resolved_markets or mkt_2.id in resolved_markets:
         return None
     if mkt_1.isResolved or mkt_2.isResolved or mkt_1.closeTime < now_mani or mkt_2.closeTime < now_mani:
         if mkt_1.isResolved:
             print(f"Market {mkt_id_1} ({mkt_1.question}) closed/resolved. Skipping and adding to resolved list.")
-            append_resolved_market(mkt_id_1)
+            append_resolved_market(mkt_id_1, mkt_1.closeTime, mkt_1.resolutionTime)
         if mkt_2.isResolved:
             print(f"Market {mkt_id_2} ({mkt_2.question}) closed/resolved. Skipping and adding to resolved list.")
-            append_resolved_market(mkt_id_2)
+            append_resolved_market(mkt_id_2, mkt_2.closeTime, mkt_2.resolutionTime)
         return None  # skip this bet
     q_1, q_2 = mkt_1.question, mkt_2.question
     if q_filter and not (filter_question(q_1, q_filter) or filter_question(q_2, q_filter)):  # either must fit
@@ -99,9 +114,11 @@ def bet_on_group_simple(
     if not limit_price_is_between_ps(lo_p, hi_p, limit_price_mkt_1):
         return None  # skip this bet
 
-    bet_amount_lo, bet_amount_hi = min(calc_bet_amount(base_amount=amount, p=lo_p, o=lo_o), int(balance / 2)), min(
-        calc_bet_amount(base_amount=amount, p=hi_p, o=hi_o), int(balance / 2)
-    )
+    account.maybe_reconcile()
+    balance = account.balance
+    max_amount_lo, max_amount_hi = amounts_to_limit([lo_mkt, hi_mkt], [limit_price_lo, limit_price_hi])
+    bet_amount_lo = int(min(calc_bet_amount(base_amount=amount, p=lo_p, o=lo_o), int(balance / 2), max_amount_lo))
+    bet_amount_hi = int(min(calc_bet_amount(base_amount=amount, p=hi_p, o=hi_o), int(balance / 2), max_amount_hi))
     if not already_printed:
         print(f"Group: {group_name}")
         print(f"q: {cq_1:>44} | p_mkt: {mkt_p_1*100:6.1f} %")
@@ -114,32 +131,81 @@ def bet_on_group_simple(
         print("-" * 10)
         return None  # skip this bet
 
-    lo_fn = partial(
-        make_bet_and_cancel,
-        wrapper=wrapper,
-        amount=bet_amount_lo,
-        contract_id=lo_mkt.id,
-        binary_outcome=lo_o,
-        limit_p=limit_price_lo,
-        dry_run=dry_run,
-    )
-    hi_fn = partial(
-        make_bet_and_cancel,
-        wrapper=wrapper,
-        amount=bet_amount_hi,
-        contract_id=hi_mkt.id,
-        binary_outcome=hi_o,
-        limit_p=limit_price_hi,
-        dry_run=dry_run,
-    )
-    with Pool(2) as p:
-        res_lo = p.apply_async(lo_fn)
-        res_hi = p.apply_async(hi_fn)
-        p.close()
-        p.join()
-    success = res_hi or res_lo
+    legs = [
+        Order(contract_id=lo_mkt.id, outcome=lo_o, amount=bet_amount_lo, limit_p=limit_price_lo, mkt_p=lo_mkt.probability),
+        Order(contract_id=hi_mkt.id, outcome=hi_o, amount=bet_amount_hi, limit_p=limit_price_hi, mkt_p=hi_mkt.probability),
+    ]
+    bet_lo, bet_hi = (result.bet if is_filled(result) else None for result in executor.execute_legs(legs, unwind=unwind))
+    success = bet_lo is not None or bet_hi is not None
     if success:
-        balance = get_balance()
+        balance = account.balance
+        print(f"New balance: {balance:.0f} M")
+        if balance < 1:
+            print("========================================")
+            print("Balance too low. Return.")
+            return False  # end all betting
+        print("-" * 10)
+
+    if sleep > 0:
+        time.sleep(sleep)
+    return True
+
+
+def bet_on_group_consensus(group_name, group_members, margin, executor, q_filter, amount, account, min_bet, sleep, verbose, unwind=False):
+    """Bets on a group of any number of markets with identical or complementary outcomes (N-way mode).
+    All probabilities are mapped into the probability space of the group (1 - p for complementary markets),
+    one consensus limit price is computed for the whole group, and every market that is off gets (at most) one order
+    towards it, in its own probability space. For two markets, the prices are the same as in `bet_on_group_simple`.
+    """
+    now_mani = now()
+    resolved_markets = get_resolved_markets()
+    markets = []  # (market, is_complementary, p in group space)
+    for mkt_id, is_complementary in group_members:
+        if mkt_id in resolved_markets:
+            continue
+        mkt = get_market_from_manifold(mkt_id)
+        if mkt.isResolved or mkt.closeTime < now_mani:
+            print(f"Market {mkt_id} ({mkt.question}) closed/resolved. Skipping and adding to resolved list.")
+            append_resolved_market(mkt_id, mkt.closeTime, mkt.resolutionTime)
+            continue
+        markets.append((mkt, is_complementary, 1 - mkt.probability if is_complementary else mkt.probability))
+    if len(markets) < 2:
+        return None  # skip this bet
+    if q_filter and not any(filter_question(mkt.question, q_filter) for mkt, _, _ in markets):  # any must fit
+        return None  # skip this bet
+
+    group_ps = [p for _, _, p in markets]
+    diff = max(group_ps) - min(group_ps)
+    consensus_p = limit_price_consensus(group_ps)  # in group space
+    if verbose or diff >= margin:
+        print(f"Group: {group_name}")
+        for mkt, is_complementary, p in markets:
+            print(f"q: {minimal_question(mkt.question):>44} | p_mkt: {p*100:6.1f} %{' (complementary)' if is_complementary else ''}")
+        print(f"diff: {diff*100:21.1f} % | limit: {consensus_p*100:6.1f} %\n")
+    if diff < margin:
+        return None  # skip this bet
+
+    account.maybe_reconcile()
+    balance = account.balance
+    limit_ps = [1 - consensus_p if is_complementary else consensus_p for _, is_complementary, _ in markets]
+    max_amounts = amounts_to_limit([mkt for mkt, _, _ in markets], limit_ps)
+    orders, directions = [], set()
+    for (mkt, is_complementary, p), limit_p, max_amount in zip(markets, limit_ps, max_amounts):
+        if abs(p - consensus_p) < 0.001:
+            continue  # already at the consensus
+        o = binary_outcome(mkt.probability, limit_p)
+        bet_amount = int(min(calc_bet_amount(base_amount=amount, p=mkt.probability, o=o), int(balance / len(markets)), max_amount))
+        if bet_amount >= min_bet:
+            orders.append(Order(contract_id=mkt.id, outcome=o, amount=bet_amount, limit_p=limit_p, mkt_p=mkt.probability))
+            directions.add(p < consensus_p)  # up or down in group space
+    if len(directions) < 2:  # unhedged without orders on both sides of the consensus
+        print(f"Bet amounts on one side of the group are below the minimum bet amount of {min_bet}.")
+        print("-" * 10)
+        return None  # skip this bet
+
+    results = executor.execute_legs(orders, unwind=unwind)
+    if any(is_filled(result) for result in results):
+        balance = account.balance
         print(f"New balance: {balance:.0f} M")
         if balance < 1:
             print("========================================")
@@ -160,11 +226,21 @@ def get_groups(ignore_db=True):
     return groups
 
 
+def get_nway_groups(ignore_db=True) -> Dict[GroupName, List[Tuple[MarketId, IsComplementary]]]:
+    """Returns all groups of markets with identical or complementary outcomes as a whole (N-way mode), not in pairs."""
+    groups = dict()
+    for database in [IDENTICAL_MARKETS] if ignore_db else [IDENTICAL_MARKETS, DB]:
+        for group in get_group_index(database).group_names():
+            group_members = get_group_members(group, database)
+            if len(group_members) >= 2:
+                groups[group] = group_members
+    return groups
+
+
 def get_groups_from_db(database):
     """Returns a list of groups of markets with identical outcomes."""
     groups = dict()
-    id_groups = set(mkt_dict["group"].replace("!", "") for mkt_dict in database.values() if mkt_dict["group"] is not None)
-    for group in id_groups:
+    for group in get_group_index(database).group_names():
         if group is not None:  # filters where no group exists
             for group_name, group_markets, is_complementary in create_groups_from_str(group, database):
                 if group_name is not None:  # filters where a group exists but no pairs are possible
@@ -206,22 +282,21 @@ def parse_group_of_two_mkts(two_mkts: List[Tuple[str, bool]]) -> bool:
     return [mkt_id_1, mkt_id_2], is_complementary
 
 
+def get_group_members(group: GroupName, database: dict) -> List[Tuple[MarketId, IsComplementary]]:
+    """Returns the unresolved markets of a group, each with a flag whether its outcome is complementary ("!")."""
+    random_number = random.random()
+    return [
+        (mkt_id, has_exclamation)
+        for mkt_id, has_exclamation in get_group_index(database).members(group, include_resolved=False)
+        if not random_number > database[mkt_id]["bet_p"]
+    ]
+
+
 def create_groups_from_str(group: GroupName, database: dict) -> Tuple[GroupName, Iterable[MarketId], IsComplementary]:
     """Yields groups in sets of two markets that predict identical or complementary outcomes."""
-    random_number = random.random()
     if group is None:
         yield None, None, None
-    resolved_markets = read_resolved_markets()
-    group_mkt_collection: List[Tuple[str, bool]] = []
-    for mkt_id, mkt_dict in database.items():
-        if (
-            mkt_dict["group"] == group
-            or mkt_dict["group"] == f"!{group}"
-            and mkt_id not in resolved_markets
-            and not random_number > database[mkt_id]["bet_p"]
-        ):
-            has_exclamation = mkt_dict["group"].startswith("!")
-            group_mkt_collection.append((mkt_id, has_exclamation))
+    group_mkt_collection: List[Tuple[str, bool]] = get_group_members(group, database)
     if len(group_mkt_collection) < 2:
         yield None, None, None
     elif len(group_mkt_collection) > 2:  # add all combinations of two
@@ -246,7 +321,9 @@ def parse_args():
     )
     parser.add_argument("-r", "--repeat", type=int, default=1, help="Number of times to repeat the betting. Default: 1.")
     parser.add_argument("-d", "--dry-run", action="store_true", help="Dry run mode (no actual bets).")
-    parser.add_argument("-s", "--sleep", type=int, default=8, help="Sleep time in seconds between bets. Default: 8.")
+    parser.add_argument(
+        "-s", "--sleep", type=int, default=0, help="Extra sleep in seconds between bets (API calls are rate limited). Default: 0."
+    )
     parser.add_argument(
         "-f",
         "--filter",
@@ -255,6 +332,10 @@ def parse_args():
         help="Filter markets by question. Negative filter using '- {q_filter}' Default: None.",
     )
     parser.add_argument("-i", "--ignore-db", action="store_true", help="Ignore markets from DB (only from IDENTICAL_MARKETS")
+    parser.add_argument(
+        "-n", "--n-way", action="store_true", help="Trade each group as a whole at one consensus price instead of in pairs."
+    )
+    parser.add_argument("-u", "--unwind", action="store_true", help="Sell the filled leg again if the other leg doesn't fill.")
     parser.add_argument("-v", "--verbose", action="store_true", help="Verbose mode. Print also markets with no bet.")
     return parser.parse_args()
 
@@ -271,39 +352,49 @@ def main():
     q_filter = args.filter
     ignore_db = args.ignore_db
     verbose = args.verbose
+    unwind = args.unwind
+    n_way = args.n_way
 
     print(
-        f"Settings: amount={amount} M, min_bet={min_bet} M, margin={margin*100} %, repeat={repeat}, dry_run={dry_run}, sleep={sleep} s, q_filter={q_filter}, ignore_db={ignore_db}, verbose={verbose}"
+        f"Settings: amount={amount} M, min_bet={min_bet} M, margin={margin*100} %, repeat={repeat}, dry_run={dry_run}, sleep={sleep} s, q_filter={q_filter}, ignore_db={ignore_db}, unwind={unwind}, n_way={n_way}, verbose={verbose}"
     )
-    wrapper = api.APIWrapper(API_KEY)
+    wrapper = PooledAPIWrapper(API_KEY)
 
-    groups = get_groups(ignore_db=ignore_db)
-    balance = get_balance()
-    print(f"Balance: {balance:.0f} M")
-    if balance < 1:
+    groups = get_nway_groups(ignore_db=ignore_db) if n_way else get_groups(ignore_db=ignore_db)
+    account = Account(USER_ID, verbose=verbose)
+    print(f"Balance: {account.balance:.0f} M")
+    if account.balance < 1:
         print("========================================")
         print("Balance too low. Return.")
         return False  # end all betting
 
-    for i in range(repeat):
-        print("*" * 10 + f" Repeat {i+1}/{repeat} " + "*" * 10)
-        for group_name, (group_markets, is_complementary) in tqdm(groups.items()):
-            finished = bet_on_group_simple(
-                group_name=group_name,
-                group_markets=group_markets,
-                margin=margin,
-                wrapper=wrapper,
-                q_filter=q_filter,
-                amount=amount,
-                balance=balance,
-                min_bet=min_bet,
-                dry_run=dry_run,
-                sleep=sleep,
-                verbose=verbose,
-                is_complementary=is_complementary,
-            )
-            if finished is False:  # balance too low
-                return
+    with OrderExecutor(wrapper, account, max_workers=2, dry_run=dry_run) as executor:  # one leg executor for the whole run
+        for i in range(repeat):
+            print("*" * 10 + f" Repeat {i+1}/{repeat} " + "*" * 10)
+            if n_way:
+                get_markets_bulk((mkt_id for group_members in groups.values() for mkt_id, _ in group_members), verbose=verbose)
+            else:
+                get_markets_bulk((mkt_id for group_markets, _ in groups.values() for mkt_id in group_markets), verbose=verbose)
+            for group_name, group in tqdm(groups.items()):
+                kwargs = dict(
+                    group_name=group_name,
+                    margin=margin,
+                    executor=executor,
+                    q_filter=q_filter,
+                    amount=amount,
+                    account=account,
+                    min_bet=min_bet,
+                    sleep=sleep,
+                    verbose=verbose,
+                    unwind=unwind,
+                )
+                if n_way:
+                    finished = bet_on_group_consensus(group_members=group, **kwargs)
+                else:
+                    group_markets, is_complementary = group
+                    finished = bet_on_group_simple(group_markets=group_markets, is_complementary=is_complementary, **kwargs)
+                if finished is False:  # balance too low
+                    return
 
 
 if __name__ == "__main__":
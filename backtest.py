@@ -0,0 +1,271 @@
+import argparse
+import os
+import re
+import time
+from collections import namedtuple
+from datetime import datetime
+from typing import *
+
+import numpy as np
+
+from cpmm import amount_to_probability, pool_from_market, shares_for_amount
+from db import DB
+from decisions import bet_size, decide_batch, position_value_batch
+from forecasts import get_forecast_store
+from portfolio import Portfolio
+from scraping import get_urls_for_mkt_fn, replay_forecasts
+from utils import filter_question, should_bet_position, unpickle_something
+
+MARKETS_FOLDER = "data/markets"
+
+# what the backtest needs of a market at one point in time (`pool`: a `cpmm.Pool`, None if the market has none)
+MarketState = namedtuple("MarketState", ["question", "probability", "pool", "close_time", "resolution", "resolution_probability"])
+
+BacktestResult = namedtuple(
+    "BacktestResult",
+    [
+        "steps",  # number of market snapshots replayed
+        "bets",  # number of (simulated) fills
+        "turnover",  # M bet in total
+        "final_balance",
+        "position_value",  # M, open positions at the last known market probabilities, resolved ones at their resolution
+        "pnl",  # final balance + position value - initial balance
+        "pnl_resolved",  # part of the P&L from markets that resolved
+        "max_exposure",  # M, largest value of all open positions (at market probabilities) after a step
+        "mean_exposure",
+        "max_group_shares",  # largest absolute group position after a step
+    ],
+)
+
+
+def snapshot_time(filename) -> float:
+    """Time of a `get_markets.py` pickle (`markets_YYYY_MM_DD.pkl`): midnight at the start of its date (seconds since epoch).
+    Forecasts are replayed as of that time, so only forecasts stored before the markets were downloaded are used.
+    """
+    date = re.search(r"markets_(\d{4}_\d{2}_\d{2})\.pkl$", filename).group(1)
+    return datetime.strptime(date, "%Y_%m_%d").timestamp()
+
+
+def market_state(mkt) -> MarketState:
+    return MarketState(
+        question=mkt.question,
+        probability=mkt.probability,
+        pool=pool_from_market(mkt),
+        close_time=mkt.closeTime,
+        resolution=getattr(mkt, "resolution", None) if getattr(mkt, "isResolved", False) else None,
+        resolution_probability=getattr(mkt, "resolutionProbability", None),
+    )
+
+
+def load_market_snapshots(folder=MARKETS_FOLDER, mkt_ids=None, verbose=False) -> List[Tuple[float, Dict[str, MarketState]]]:
+    """Reads the market pickles of `get_markets.py` (oldest first) and keeps the markets in `mkt_ids` (default: the DB)."""
+    mkt_ids = set(DB) if mkt_ids is None else set(mkt_ids)
+    files = sorted(f for f in os.listdir(folder) if re.match(r"markets_\d{4}_\d{2}_\d{2}\.pkl$", f))
+    snapshots = []
+    for f in files:
+        markets = unpickle_something(os.path.join(folder, f))
+        snapshots.append((snapshot_time(f), {m.id: market_state(m) for m in markets if m.id in mkt_ids}))
+        if verbose:
+            print(f"Loaded {f}: {len(snapshots[-1][1])} markets.")
+    return snapshots
+
+
+def _urls_with_forecasts(urls, t) -> Set[str]:
+    """The pages of which the forecast store has a snapshot as of time `t`."""
+    store = get_forecast_store()
+    return set() if store is None else {url for url in urls if store.as_of(url, t) is not None}
+
+
+def _true_p(mkt_id) -> Optional[float]:
+    try:
+        true_p = DB[mkt_id]["mkt_fn"]()
+    except Exception as e:
+        print(f"Error in mkt_fn for {mkt_id}: {e}")
+        return None
+    return true_p if true_p is not None and 0 <= true_p <= 1 else None
+
+
+def _final_value(shares, invested, state: MarketState) -> float:
+    if state.resolution == "YES":
+        return max(shares, 0.0)
+    if state.resolution == "NO":
+        return max(-shares, 0.0)
+    if state.resolution == "MKT" and state.resolution_probability is not None:
+        return float(position_value_batch(shares, state.resolution_probability))
+    if state.resolution == "CANCEL":  # bets are refunded
+        return invested
+    return float(position_value_batch(shares, state.probability))
+
+
+def backtest(
+    snapshots: Sequence[Tuple[float, Dict[str, MarketState]]],
+    balance,
+    amount,
+    min_bet,
+    margin,
+    tail,
+    use_kelly,
+    kelly_scale,
+    max_shares,
+    liquidation=False,
+    to_target=False,
+    q_filter=None,
+    verbose=False,
+) -> BacktestResult:
+    """Replays market snapshots (time in seconds since epoch -> market id -> `MarketState`) through the decisions of
+    `all_538.make_all_bets`, with the 538 forecasts stored in the forecast store as of each snapshot.
+
+    Every bet is a limit order at the limit price that fills against the market's CPMM pool (up to the amount that moves
+    the market to the limit price, the rest is cancelled) and is booked like `account.Account` books real fills.
+    Our bets don't move the later snapshots, markets without a pool are skipped, fees are ignored.
+    """
+    initial_balance = balance
+    portfolio = Portfolio([])
+    invested: Dict[str, float] = {}  # M paid into each market, minus redemptions
+    last_states: Dict[str, MarketState] = {}
+    urls = {m: get_urls_for_mkt_fn(DB[m]["mkt_fn"]) for m in DB if DB[m]["mkt_fn"] is not None}
+    turnover, n_bets, exposures, max_group_shares = 0.0, 0, [], 0.0
+    for t, markets in snapshots:
+        last_states.update(markets)
+        available = _urls_with_forecasts(set().union(*urls.values()), t)
+        mkt_ids = [
+            m
+            for m, state in markets.items()
+            if m in urls
+            and state.resolution is None
+            and (state.close_time is None or state.close_time > t * 1000)
+            and state.pool is not None
+            and (not q_filter or filter_question(state.question, q_filter))
+            and urls[m] <= available
+        ]
+        with replay_forecasts(t):
+            true_ps = {m: _true_p(m) for m in mkt_ids}
+        mkt_ids = [m for m in mkt_ids if true_ps[m] is not None]
+        if mkt_ids:
+            positions = [portfolio.get_shares(m, DB) for m in mkt_ids]
+            d = decide_batch(
+                mkt_p=[markets[m].probability for m in mkt_ids],
+                true_p=[true_ps[m] for m in mkt_ids],
+                shares=[p[0] for p in positions],
+                group_shares=[p[1] for p in positions],
+                margin=margin,
+                tail=tail,
+                max_shares=max_shares,
+                liquidation=liquidation,
+            )
+            for i in np.flatnonzero(d.should_bet):
+                mkt_id, state, o, l = mkt_ids[i], markets[mkt_ids[i]], d.outcome[i], float(d.limit_p[i])
+                group_shares = portfolio.get_shares(mkt_id, DB)[1]  # includes the fills of this step, like `OrderExecutor`
+                if not should_bet_position(binary_outcome=o, shares=group_shares, max_shares=max_shares) or balance < 1:
+                    continue
+                amount_i = bet_size(
+                    pool=state.pool,
+                    mkt_p=state.probability,
+                    true_p=true_ps[mkt_id],
+                    outcome=o,
+                    limit_p=l,
+                    group_shares=group_shares,
+                    balance=balance,
+                    amount=amount,
+                    use_kelly=use_kelly,
+                    kelly_scale=kelly_scale,
+                    to_target=to_target,
+                    max_shares=max_shares,
+                    verbose=False,
+                )
+                if amount_i < min_bet:
+                    continue
+                fill = min(float(amount_i), float(amount_to_probability(state.pool, l)[0]))
+                if fill <= 0:
+                    continue
+                shares = float(shares_for_amount(state.pool, fill, o))
+                redeemed = portfolio.apply_bet(mkt_id, o, shares)
+                balance += redeemed - fill
+                invested[mkt_id] = invested.get(mkt_id, 0.0) + fill - redeemed
+                turnover += fill
+                n_bets += 1
+                if verbose:
+                    print(
+                        f"{time.strftime('%Y-%m-%d', time.localtime(t))} | {state.question[:44]:44} | p_mkt: {state.probability*100:5.1f} % "
+                        f"| p_tru: {true_ps[mkt_id]*100:5.1f} % | {o:>3} {fill:5.0f} M -> {shares:5.0f} shares | balance: {balance:.0f} M"
+                    )
+        held = [m for m in invested if portfolio.shares(m) != 0]
+        exposures.append(sum(float(position_value_batch(portfolio.shares(m), last_states[m].probability)) for m in held))
+        max_group_shares = max([max_group_shares] + [abs(portfolio.get_shares(m, DB)[1]) for m in held])
+
+    values = {m: _final_value(portfolio.shares(m), invested[m], last_states[m]) for m in invested}
+    position_value = sum(values.values())
+    pnl_resolved = sum(values[m] - invested[m] for m in invested if last_states[m].resolution is not None)
+    return BacktestResult(
+        steps=len(snapshots),
+        bets=n_bets,
+        turnover=turnover,
+        final_balance=balance,
+        position_value=position_value,
+        pnl=balance + position_value - initial_balance,
+        pnl_resolved=pnl_resolved,
+        max_exposure=max(exposures, default=0.0),
+        mean_exposure=float(np.mean(exposures)) if exposures else 0.0,
+        max_group_shares=max_group_shares,
+    )
+
+
+def print_result(result: BacktestResult, initial_balance):
+    print("========================================")
+    print(f"Steps: {result.steps} | bets: {result.bets} | turnover: {result.turnover:.0f} M")
+    print(f"Balance: {initial_balance:.0f} M -> {result.final_balance:.0f} M | positions: {result.position_value:.0f} M")
+    print(
+        f"P&L: {result.pnl:.0f} M ({result.pnl / max(initial_balance, 1) * 100:.1f} %), from resolved markets: {result.pnl_resolved:.0f} M"
+    )
+    print(
+        f"Exposure: max {result.max_exposure:.0f} M, mean {result.mean_exposure:.0f} M | max group position: {result.max_group_shares:.0f} shares"
+    )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replay stored market snapshots and 538 forecasts through the all_538 strategy.")
+    parser.add_argument(
+        "-mf", "--markets-folder", type=str, default=MARKETS_FOLDER, help=f"Folder of market pickles. Default: {MARKETS_FOLDER}."
+    )
+    parser.add_argument("-b", "--balance", type=float, default=1_000, help="Starting balance in M. Default: 1_000.")
+    parser.add_argument("-a", "--amount", type=int, default=10, help="Amount to bet in M. Default: 10.")
+    parser.add_argument("-mb", "--min-bet", type=int, default=1, help="Minimum bet amount in M. Default: 1.")
+    parser.add_argument("-m", "--margin", type=float, default=2.0, help="Margin to trigger a bet in percent. Default: 2.")
+    parser.add_argument("-t", "--tail", type=float, default=5, help="Do not trade the tails: (0 + tail, 100 - tail) %. Default: 5.")
+    parser.add_argument("-tt", "--to-target", action="store_true", help="Bet what moves each market to the limit price.")
+    parser.add_argument("-k", "--use-kelly", action="store_true", help="Use Kelly criterion instead of fixed amount.")
+    parser.add_argument("-ks", "--kelly-scale", type=float, default=0.1, help="Kelly scale factor. Default: 0.1.")
+    parser.add_argument("-f", "--filter", type=str, default=None, help="Filter markets by question. Default: None.")
+    parser.add_argument("-ms", "--max-shares", type=int, default=1_000, help="Maximum shares to hold in one market. Default: 1_000.")
+    parser.add_argument("-l", "--liquidation", action="store_true", help="Make only liquidating bets.")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Verbose mode. Print every simulated bet.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    start = time.monotonic()
+    snapshots = load_market_snapshots(args.markets_folder, verbose=args.verbose)
+    print(f"Loaded {len(snapshots)} market snapshots in {time.monotonic() - start:.1f} s.")
+    start = time.monotonic()
+    result = backtest(
+        snapshots,
+        balance=args.balance,
+        amount=args.amount,
+        min_bet=args.min_bet,
+        margin=args.margin / 100,
+        tail=args.tail / 100,
+        use_kelly=args.use_kelly,
+        kelly_scale=args.kelly_scale,
+        max_shares=args.max_shares,
+        liquidation=args.liquidation,
+        to_target=args.to_target,
+        q_filter=args.filter,
+        verbose=args.verbose,
+    )
+    print(f"Replayed in {time.monotonic() - start:.1f} s.")
+    print_result(result, args.balance)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,7 @@ from tqdm import tqdm
 
 from find_markets import find_markets
 from manifoldpy import api
+from transport import PooledAPIWrapper
 from utils import load_config, unpickle_something
 
 API_KEY, _ = load_config()
@@ -70,7 +71,9 @@ def parse_args():
     parser.add_argument("-c", "--creator", type=str, default="", help="Creator to search for.")
     parser.add_argument("-vc", "--neg-creator", type=str, default="", help="Creator to avoid.")
     parser.add_argument("-i", "--include-db", action="store_true", help="Include markets that are already in the DB.")
-    parser.add_argument("-s", "--sleep", type=int, default=8, help="Sleep time in seconds between bets. Default: 8.")
+    parser.add_argument(
+        "-s", "--sleep", type=int, default=0, help="Extra sleep in seconds between bets (API calls are rate limited). Default: 0."
+    )
     parser.add_argument("-o", "--old", action="store_true", help="Only bet on old markets.")
 
     args = parser.parse_args()
@@ -100,7 +103,7 @@ def main():
         old=old,
     )
 
-    wrapper = api.APIWrapper(API_KEY)
+    wrapper = PooledAPIWrapper(API_KEY)
     counter = 0
     already_bet = set()
     random.shuffle(markets)
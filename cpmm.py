@@ -0,0 +1,125 @@
+from collections import namedtuple
+from typing import *
+
+import numpy as np
+
+BISECTION_ITERATIONS = 60  # bisection steps: the search interval shrinks by a factor of 2^60
+
+# Manifold's constant-product market maker ("cpmm-1"): YES and NO reserves of the pool and the weight `p`.
+# Invariant: YES^p * NO^(1 - p) = const, probability = p * NO / (p * NO + (1 - p) * YES).
+# A bet of M on YES adds M to both reserves (M YES + M NO shares are minted) and takes YES shares out until the
+# invariant holds again; the bettor gets those. Fees and matching with other users' limit orders are not modeled.
+Pool = namedtuple("Pool", ["yes", "no", "p"])
+
+
+def pool_from_market(mkt) -> Optional[Pool]:
+    """Returns the pool of a binary CPMM market (a `manifoldpy` market) or None if it hasn't got one."""
+    if getattr(mkt, "mechanism", None) != "cpmm-1" or not mkt.pool or mkt.p is None:
+        return None
+    return Pool(yes=mkt.pool["YES"], no=mkt.pool["NO"], p=mkt.p)
+
+
+def pools_from_markets(mkts) -> Tuple[Pool, np.ndarray]:
+    """Stacks the pools of several markets into one `Pool` of arrays. Also returns which markets have a pool
+    (the others get a placeholder pool at 50 %).
+    """
+    pools = [pool_from_market(mkt) for mkt in mkts]
+    has_pool = np.array([pool is not None for pool in pools], dtype=bool)
+    pools = [pool if pool is not None else Pool(1.0, 1.0, 0.5) for pool in pools]
+    return Pool(*(np.array(values, dtype=float) for values in zip(*pools))), has_pool
+
+
+def _arrays(pool: Pool, *args):
+    return [np.asarray(x, dtype=float) for x in (pool.yes, pool.no, pool.p) + args]
+
+
+def probability(pool: Pool) -> np.ndarray:
+    yes, no, p = _arrays(pool)
+    return p * no / (p * no + (1 - p) * yes)
+
+
+def _pool_after_bet(yes, no, p, amount, is_yes):
+    """Reserves after betting `amount` on YES (`is_yes`) or NO."""
+    k_log = p * np.log(yes) + (1 - p) * np.log(no)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        new_no_yes_bet = no + amount
+        new_yes_yes_bet = np.exp((k_log - (1 - p) * np.log(new_no_yes_bet)) / p)
+        new_yes_no_bet = yes + amount
+        new_no_no_bet = np.exp((k_log - p * np.log(new_yes_no_bet)) / (1 - p))
+    return np.where(is_yes, new_yes_yes_bet, new_yes_no_bet), np.where(is_yes, new_no_yes_bet, new_no_no_bet)
+
+
+def shares_for_amount(pool: Pool, amount, outcome) -> np.ndarray:
+    """Shares received for betting `amount` on `outcome` ("YES"/"NO", or arrays of them)."""
+    yes, no, p, amount = _arrays(pool, amount)
+    is_yes = np.asarray(outcome) == "YES"
+    new_yes, new_no = _pool_after_bet(yes, no, p, amount, is_yes)
+    return np.where(is_yes, yes + amount - new_yes, no + amount - new_no)
+
+
+def probability_after_bet(pool: Pool, amount, outcome) -> np.ndarray:
+    """Market probability after betting `amount` on `outcome`."""
+    yes, no, p, amount = _arrays(pool, amount)
+    new_yes, new_no = _pool_after_bet(yes, no, p, amount, np.asarray(outcome) == "YES")
+    return p * new_no / (p * new_no + (1 - p) * new_yes)
+
+
+def amount_to_probability(pool: Pool, target_p) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the amount (and outcome) of the bet that moves the market exactly to `target_p`.
+    The amount is 0 if the market is already there.
+    """
+    yes, no, p, target_p = _arrays(pool, target_p)
+    is_yes = target_p > probability(pool)
+    # at the target, YES / NO = ratio; together with the invariant, this fixes the reserves after the bet
+    ratio = p * (1 - target_p) / ((1 - p) * target_p)
+    k_log = p * np.log(yes) + (1 - p) * np.log(no)
+    new_no = np.exp(k_log - p * np.log(ratio))  # YES bet: NO reserve grows by the amount
+    new_yes = np.exp(k_log + (1 - p) * np.log(ratio))  # NO bet: YES reserve grows by the amount
+    amount = np.maximum(0.0, np.where(is_yes, new_no - no, new_yes - yes))
+    return amount, np.where(is_yes, "YES", "NO").astype(object)
+
+
+def amount_for_shares(pool: Pool, shares, outcome) -> np.ndarray:
+    """Amount to bet on `outcome` to receive `shares` shares (by bisection; every share costs less than M1)."""
+    yes, no, p, shares = _arrays(pool, shares)
+    shares = np.maximum(0.0, shares)
+    is_yes = np.asarray(outcome) == "YES"
+    lo, hi = np.zeros_like(shares), shares.copy()
+    for _ in range(BISECTION_ITERATIONS):
+        x = (lo + hi) / 2
+        new_yes, new_no = _pool_after_bet(yes, no, p, x, is_yes)
+        too_few = np.where(is_yes, yes + x - new_yes, no + x - new_no) < shares
+        lo, hi = np.where(too_few, x, lo), np.where(too_few, hi, x)
+    return hi
+
+
+def _marginal_shares(new_yes, new_no, p, is_yes) -> np.ndarray:
+    """Derivative of the shares received with respect to the amount bet (1 / marginal price), from the reserves after the bet."""
+    return np.where(is_yes, 1 + (1 - p) / p * new_yes / new_no, 1 + p / (1 - p) * new_no / new_yes)
+
+
+def kelly_cpmm(pool: Pool, true_p, bankroll, max_fraction=1.0) -> np.ndarray:
+    """Kelly fraction of the bankroll to bet on the market, with the exact price impact of the bet.
+
+    Maximizes E[log(wealth)] = true_p * log(bankroll - x + shares(x)) + (1 - true_p) * log(bankroll - x) over the amount x
+    (for NO bets with the probabilities swapped), by bisection on its derivative. Replaces the midpoint approximation
+    of `kelly.kelly_manifold`. Never bets past `true_p`, where every further share costs more than it is worth.
+    """
+    yes, no, p, true_p, bankroll = _arrays(pool, true_p, bankroll)
+    has_bankroll = bankroll > 0
+    if not np.any(has_bankroll):  # nothing to bet
+        return np.zeros(np.broadcast(yes, no, p, true_p, bankroll).shape)
+    pool = Pool(yes, no, p)
+    is_yes = true_p > probability(pool)
+    p_win = np.where(is_yes, true_p, 1 - true_p)
+    hi, _ = amount_to_probability(pool, true_p)
+    hi = np.where(has_bankroll, np.minimum(hi, bankroll * max_fraction * (1 - 1e-12)), 0.0)
+    lo = np.zeros_like(hi)
+    bankroll = np.where(has_bankroll, bankroll, 1.0)  # no division by zero (the search interval is [0, 0] there)
+    for _ in range(BISECTION_ITERATIONS):
+        x = (lo + hi) / 2
+        new_yes, new_no = _pool_after_bet(yes, no, p, x, is_yes)
+        s = np.where(is_yes, yes + x - new_yes, no + x - new_no)
+        slope = p_win * (_marginal_shares(new_yes, new_no, p, is_yes) - 1) / (bankroll - x + s) - (1 - p_win) / (bankroll - x)
+        lo, hi = np.where(slope > 0, x, lo), np.where(slope > 0, hi, x)
+    return lo / bankroll
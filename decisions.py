@@ -0,0 +1,132 @@
+import math
+from collections import namedtuple
+
+import numpy as np
+
+from cpmm import amount_for_shares, amount_to_probability, kelly_cpmm
+from kelly import kelly_manifold
+
+Decisions = namedtuple(
+    "Decisions",
+    ["outcome", "limit_p", "should_bet", "is_liq_bet", "ev_mkt", "ev_true", "kelly"],
+)
+
+
+def limit_price_batch(mkt_p, true_p, tail, round_to_digits=2) -> np.ndarray:
+    """`utils.limit_price` for arrays."""
+    mkt_p, true_p = np.asarray(mkt_p, dtype=float), np.asarray(true_p, dtype=float)
+    down = np.maximum(tail, np.ceil(true_p * 10**round_to_digits) / 10**round_to_digits)
+    up = np.minimum(1 - tail, np.floor(true_p * 10**round_to_digits) / 10**round_to_digits)
+    return np.where(true_p < mkt_p, down, up)
+
+
+def should_bet_probabilities_batch(mkt_p, true_p, margin, tail) -> np.ndarray:
+    """`utils.should_bet_probabilities` for arrays."""
+    assert margin >= 0.01, "Margin must be at least 1 % to avoid weird effects."
+    assert tail >= 0.02, "Don't trade at the extremes."
+    mkt_p, true_p = np.asarray(mkt_p, dtype=float), np.asarray(true_p, dtype=float)
+    tail_adjustment = 0.001  # prevents unnecessary trades (mkt_p at 0.05001, limit_price at 0.05)
+    in_lower_tail = (true_p < mkt_p) & (mkt_p <= tail + tail_adjustment)
+    in_upper_tail = (true_p > mkt_p) & (mkt_p >= 1 - (tail + tail_adjustment))
+    return (np.abs(mkt_p - true_p) >= margin) & ~in_lower_tail & ~in_upper_tail
+
+
+def limit_price_is_between_ps_batch(mkt_p, true_p, limit_p) -> np.ndarray:
+    """`utils.limit_price_is_between_ps` for arrays."""
+    mkt_p, true_p, limit_p = (np.asarray(x, dtype=float) for x in (mkt_p, true_p, limit_p))
+    return np.where(true_p < mkt_p, (true_p < limit_p) & (limit_p < mkt_p), (mkt_p < limit_p) & (limit_p < true_p))
+
+
+def position_value_batch(shares, probability) -> np.ndarray:
+    """`utils.get_position_value` for arrays."""
+    shares, probability = np.asarray(shares, dtype=float), np.asarray(probability, dtype=float)
+    return probability * np.maximum(shares, 0) + (1 - probability) * np.maximum(-shares, 0)
+
+
+def kelly_manifold_batch(mkt_p, true_p, max_fraction=1.0) -> np.ndarray:
+    """`kelly.kelly_manifold` for arrays."""
+    mkt_p, true_p = np.asarray(mkt_p, dtype=float), np.asarray(true_p, dtype=float)
+    bet_no = mkt_p > true_p  # betting NO is just like betting YES on the opposite outcome
+    p = np.where(bet_no, 1 - true_p, true_p)
+    mkt_p = np.where(bet_no, 1 - mkt_p, mkt_p)
+    q = 1 - p
+    with np.errstate(divide="ignore"):  # mkt_p = true_p = 0: a = inf, f = p
+        a = 1 / ((mkt_p + p) / 2)
+    b = 1
+    return np.minimum(max_fraction, p / b - q / a)
+
+
+def decide_batch(mkt_p, true_p, shares, group_shares, margin, tail, max_shares=1_000, liquidation=False) -> Decisions:
+    """The decisions of `all_538.evaluate_market` (outside of verbose mode) for many markets at once.
+
+    Takes arrays of market and true probabilities, shares held in each market and in its group
+    (the same as `shares` for markets without a group). Returns a `Decisions` of arrays:
+    the outcome ("YES"/"NO"), the limit price, whether to bet, whether the bet would liquidate (part of) the position,
+    the position's value at the market and at the true probability, and the Kelly fraction.
+    Gives the same results as the scalar functions in `utils` and `kelly`.
+    """
+    mkt_p, true_p = np.asarray(mkt_p, dtype=float), np.asarray(true_p, dtype=float)
+    shares, group_shares = np.asarray(shares, dtype=float), np.asarray(group_shares, dtype=float)
+    is_yes = ~(true_p < mkt_p)
+    outcome = np.where(is_yes, "YES", "NO").astype(object)
+    is_liq_bet = np.where(is_yes, shares < 1, shares > 1)
+    limit_p = limit_price_batch(mkt_p, true_p, tail)
+    position_ok = np.where(is_yes, ~(group_shares > max_shares), ~(group_shares < -max_shares))
+    should_bet = (
+        (is_liq_bet | (not liquidation))
+        & ~(np.abs(mkt_p - limit_p) < 0.001)
+        & limit_price_is_between_ps_batch(mkt_p, true_p, limit_p)
+        & (should_bet_probabilities_batch(mkt_p, true_p, margin, tail) | is_liq_bet)
+        & position_ok
+    )
+    return Decisions(
+        outcome=outcome,
+        limit_p=limit_p,
+        should_bet=should_bet,
+        is_liq_bet=is_liq_bet,
+        ev_mkt=position_value_batch(shares, mkt_p),
+        ev_true=position_value_batch(shares, true_p),
+        kelly=kelly_manifold_batch(mkt_p, true_p),
+    )
+
+
+def bet_size(
+    pool,
+    mkt_p,
+    true_p,
+    outcome,
+    limit_p,
+    group_shares,
+    balance,
+    amount,
+    use_kelly,
+    kelly_scale,
+    to_target=False,
+    max_shares=1_000,
+    verbose=True,
+) -> int:
+    """The amount `all_538.place_bet` bets on one market (before the minimum bet check).
+    `pool` is the market's `cpmm.Pool` or None, `balance` the balance to size the bet from.
+    """
+    if use_kelly:
+        if pool is not None:  # exact price impact of the bet
+            f = float(kelly_cpmm(pool, true_p=true_p, bankroll=balance))
+        else:
+            f = kelly_manifold(mkt_p=mkt_p, true_p=true_p)
+        if verbose:
+            print(f"Kelly fraction to bet: {f:.2f} (scale: {kelly_scale:.2f} --> {f*kelly_scale:.2f})")
+        amount = round(f * balance * kelly_scale)
+    else:
+        amount = min(amount, math.floor(balance))
+    if to_target and pool is not None:  # one order instead of one per --repeat pass
+        target_amount = float(amount_to_probability(pool, limit_p)[0])
+        shares_left = max(0.0, max_shares - group_shares if outcome == "YES" else max_shares + group_shares)
+        max_shares_amount = float(amount_for_shares(pool, shares_left, outcome))
+        kelly_amount = amount if use_kelly else round(float(kelly_cpmm(pool, true_p=true_p, bankroll=balance)) * balance * kelly_scale)
+        if verbose:
+            print(
+                f"Amount to move the market to {limit_p*100:.0f} %: {target_amount:.0f} M "
+                f"(up to max_shares: {max_shares_amount:.0f} M, Kelly: {kelly_amount:.0f} M)"
+            )
+        amount = math.floor(min(math.ceil(target_amount), max_shares_amount, kelly_amount))
+    return amount
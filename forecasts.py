@@ -0,0 +1,176 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from typing import *
+
+import numpy as np
+
+FORECAST_DIR = "data/forecasts"
+
+
+def content_hash(teams, columns, values) -> str:
+    """Hash of a table's content: the same teams, columns and values always give the same hash."""
+    h = hashlib.sha1("\n".join(map(str, teams)).encode() + b"\0" + "\n".join(map(str, columns)).encode() + b"\0")
+    h.update(np.ascontiguousarray(values, dtype=float).tobytes())
+    return h.hexdigest()
+
+
+def page_hash(text) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class Snapshot(namedtuple("Snapshot", ["source", "fetched_at", "content_hash", "page_hash", "teams", "columns", "values"])):
+    """A forecast table (teams x metrics) as fetched from `source` at `fetched_at` (seconds since epoch).
+    `page_hash` is the hash of the page it was parsed from (None if unknown).
+    """
+
+    def get(self, team, column) -> float:
+        return float(self.values[self.teams.index(team), self.columns.index(column)])
+
+
+class ForecastStore:
+    """Append-only history of parsed forecast tables, one compressed NumPy file per snapshot.
+
+    Every source (a page url, or the url of a csv) gets a directory named by the hash of the source.
+    A snapshot is only appended if its content differs from the latest one, so the files are the versions of the forecast.
+    File names start with the fetch time, so "as of" queries only list the directory and load one file.
+    A sidecar `pages.tsv` maps the hashes of the pages seen to the snapshot they parsed into (also when nothing was appended),
+    so an unchanged page is never parsed twice.
+    """
+
+    def __init__(self, root=FORECAST_DIR):
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self._lock = threading.Lock()
+        self._loaded: Dict[str, Snapshot] = {}  # path -> snapshot (files never change)
+
+    def _dir(self, source) -> str:
+        return os.path.join(self.root, hashlib.sha1(source.encode("utf-8")).hexdigest())
+
+    def _paths(self, source) -> List[str]:
+        """Snapshot files of a source, oldest first."""
+        try:
+            names = sorted(n for n in os.listdir(self._dir(source)) if n.endswith(".npz"))
+        except FileNotFoundError:
+            return []
+        return [os.path.join(self._dir(source), n) for n in names]
+
+    @staticmethod
+    def _fetched_at(path) -> float:
+        return int(os.path.basename(path).split("_")[0]) / 1000
+
+    def _load(self, path) -> Snapshot:
+        with self._lock:
+            if path not in self._loaded:
+                with np.load(path, allow_pickle=False) as f:
+                    self._loaded[path] = Snapshot(
+                        source=str(f["source"]),
+                        fetched_at=self._fetched_at(path),
+                        content_hash=str(f["content_hash"]),
+                        page_hash=str(f["page_hash"]) or None,
+                        teams=f["teams"].tolist(),
+                        columns=f["columns"].tolist(),
+                        values=f["values"],
+                    )
+            return self._loaded[path]
+
+    def _pages_path(self, source) -> str:
+        return os.path.join(self._dir(source), "pages.tsv")
+
+    def _note_page(self, source, page_hash, path):
+        with open(self._pages_path(source), "a") as f:
+            f.write(f"{page_hash}\t{os.path.basename(path)}\n")
+
+    def _page_snapshots(self, source) -> Dict[str, str]:
+        """Page hash -> name of the snapshot file it parsed into (the last one, if a page was seen more than once)."""
+        try:
+            with open(self._pages_path(source), "r") as f:
+                return dict(line.rstrip("\n").split("\t") for line in f if "\t" in line)
+        except FileNotFoundError:
+            return {}
+
+    def latest_for_page(self, source, page_hash) -> Optional[Snapshot]:
+        """The latest snapshot if the page with this hash parses into it (so the page needn't be parsed again), else None."""
+        paths = self._paths(source)
+        if not paths:
+            return None
+        latest = self._load(paths[-1])
+        if latest.page_hash == page_hash or self._page_snapshots(source).get(page_hash) == os.path.basename(paths[-1]):
+            return latest
+        return None
+
+    def record(self, source, teams, columns, values, fetched_at=None, page_hash=None) -> bool:
+        """Appends a snapshot of a table unless the latest snapshot has the same content. Returns whether it was appended.
+        Either way, `page_hash` (of the page the table was parsed from) is mapped to the latest snapshot.
+        """
+        values = np.asarray(values, dtype=float)
+        digest = content_hash(teams, columns, values)
+        paths = self._paths(source)
+        if paths and self._load(paths[-1]).content_hash == digest:
+            if page_hash is not None and self.latest_for_page(source, page_hash) is None:
+                self._note_page(source, page_hash, paths[-1])
+            return False
+        fetched_at = time.time() if fetched_at is None else fetched_at
+        os.makedirs(self._dir(source), exist_ok=True)
+        path = os.path.join(self._dir(source), f"{int(round(fetched_at * 1000)):013d}_{digest[:16]}.npz")
+        fd, tmp_path = tempfile.mkstemp(dir=self._dir(source), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.savez_compressed(
+                f,
+                source=np.array(source),
+                content_hash=np.array(digest),
+                page_hash=np.array(page_hash or ""),
+                teams=np.array([str(t) for t in teams]),
+                columns=np.array([str(c) for c in columns]),
+                values=values,
+            )
+        os.replace(tmp_path, path)  # readers never see half a file
+        if page_hash is not None:
+            self._note_page(source, page_hash, path)
+        return True
+
+    def times(self, source) -> np.ndarray:
+        """Fetch times of all snapshots of a source, oldest first."""
+        return np.array([self._fetched_at(p) for p in self._paths(source)], dtype=float)
+
+    def latest(self, source) -> Optional[Snapshot]:
+        paths = self._paths(source)
+        return self._load(paths[-1]) if paths else None
+
+    def as_of(self, source, t) -> Optional[Snapshot]:
+        """The forecast as it was known at time `t` (seconds since epoch): the latest snapshot fetched at or before `t`."""
+        paths = self._paths(source)
+        i = np.searchsorted(self.times(source), t, side="right")
+        return self._load(paths[i - 1]) if i > 0 else None
+
+    def value(self, source, team, column, t=None) -> Optional[float]:
+        """Latest value (or the value as of `t`) of one team and metric. None if there is no snapshot yet."""
+        snapshot = self.latest(source) if t is None else self.as_of(source, t)
+        return None if snapshot is None else snapshot.get(team, column)
+
+    def history(self, source, team, column) -> Tuple[np.ndarray, np.ndarray]:
+        """Fetch times and values of one team and metric over all snapshots (NaN where the team or metric is missing)."""
+        snapshots = [self._load(p) for p in self._paths(source)]
+        values = [s.get(team, column) if team in s.teams and column in s.columns else np.nan for s in snapshots]
+        return np.array([s.fetched_at for s in snapshots], dtype=float), np.array(values, dtype=float)
+
+
+_store = None
+_store_failed = False
+_store_lock = threading.Lock()
+
+
+def get_forecast_store() -> Optional[ForecastStore]:
+    """Returns the shared store, or None if it can't be opened (e.g. read-only file system)."""
+    global _store, _store_failed
+    with _store_lock:
+        if _store is None and not _store_failed:
+            try:
+                _store = ForecastStore(FORECAST_DIR)
+            except OSError as e:
+                print(f"Could not open forecast store {FORECAST_DIR}: {e}. Forecasts are not recorded.")
+                _store_failed = True
+        return _store
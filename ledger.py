@@ -0,0 +1,128 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import *
+
+LEDGER_DB = "data/bets.sqlite"
+RESYNC_WINDOW = 60 * 1000  # re-fetch the last minute of bets on every sync (bets may show up slightly out of order)
+ALL_MARKETS = ""  # contract id used for syncs of all bets of a user
+
+
+def _is_open(bet, now_ms) -> bool:
+    """Whether a bet is a limit order that may still fill or be cancelled."""
+    if bet.get("limitProb") is None or bet.get("isFilled") or bet.get("isCancelled"):
+        return False
+    return bet.get("expiresAt") is None or bet["expiresAt"] > now_ms
+
+
+class BetLedger:
+    """Local, persistent copy of a user's bets (SQLite), synced incrementally with the API.
+
+    Bets are keyed by (user, market, bet id, created time) because bet ids alone are not unique.
+    Each sync only fetches the bets created since the last sync (minus `RESYNC_WINDOW`), via the `after` cursor.
+    Open limit orders may still fill or be cancelled, so their markets are re-fetched back to the oldest open order on every sync.
+    """
+
+    def __init__(self, path=LEDGER_DB):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._conn:
+            has_open_orders = self._conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'open_orders'").fetchone()
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS bets ("
+                "user_id TEXT, contract_id TEXT, bet_id TEXT, created_time INTEGER, bet TEXT, "
+                "PRIMARY KEY (user_id, contract_id, bet_id, created_time))"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS syncs (user_id TEXT, contract_id TEXT, synced_until INTEGER, PRIMARY KEY (user_id, contract_id))"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS open_orders ("
+                "user_id TEXT, contract_id TEXT, bet_id TEXT, created_time INTEGER, "
+                "PRIMARY KEY (user_id, contract_id, bet_id, created_time))"
+            )
+            if not has_open_orders:  # ledger of an older version: find the open orders among the stored bets
+                now_ms = int(time.time() * 1000)
+                rows = self._conn.execute("SELECT user_id, contract_id, bet_id, created_time, bet FROM bets").fetchall()
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO open_orders VALUES (?, ?, ?, ?)", [r[:4] for r in rows if _is_open(json.loads(r[4]), now_ms)]
+                )
+
+    def synced_until(self, user_id, mkt_id=None) -> int:
+        """Returns the creation time of the newest bet seen by the last sync (0 if never synced)."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT synced_until FROM syncs WHERE user_id = ? AND contract_id = ?", (user_id, mkt_id or ALL_MARKETS)
+            ).fetchone()
+        return 0 if row is None else row[0]
+
+    def add_bets(self, user_id, bets: Iterable[Dict[str, Any]], mkt_id=None, synced_until=None):
+        """Inserts (or updates) bets and keeps track of the open orders among them. Records the sync if `synced_until` is given."""
+        bets = list(bets)
+        now_ms = int(time.time() * 1000)
+        keys = [(user_id, b["contractId"], b["id"], b["createdTime"]) for b in bets]
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO bets VALUES (?, ?, ?, ?, ?)", [k + (json.dumps(b),) for k, b in zip(keys, bets)])
+            self._conn.executemany(
+                "DELETE FROM open_orders WHERE user_id = ? AND contract_id = ? AND bet_id = ? AND created_time = ?", keys
+            )
+            self._conn.executemany("INSERT INTO open_orders VALUES (?, ?, ?, ?)", [k for k, b in zip(keys, bets) if _is_open(b, now_ms)])
+            if synced_until is not None:
+                self._conn.execute("INSERT OR REPLACE INTO syncs VALUES (?, ?, ?)", (user_id, mkt_id or ALL_MARKETS, synced_until))
+
+    def open_orders(self, user_id, mkt_id=None) -> Dict[str, int]:
+        """Market id -> creation time of the oldest open limit order of the user there (on one market or all markets)."""
+        query, params = "SELECT contract_id, MIN(created_time) FROM open_orders WHERE user_id = ?", [user_id]
+        if mkt_id is not None:
+            query, params = query + " AND contract_id = ?", params + [mkt_id]
+        with self._lock:
+            return dict(self._conn.execute(query + " GROUP BY contract_id", params).fetchall())
+
+    def sync(self, user_id, fetch_bets: Callable[[int, Optional[str]], List[Dict[str, Any]]], mkt_id=None) -> int:
+        """Fetches new bets with `fetch_bets(after, mkt_id)` and stores them. `mkt_id=None` syncs all markets of the user.
+        The markets with open orders are fetched again back to their oldest open order, so fills and cancellations are seen.
+        Returns the number of bets fetched.
+        """
+        last = self.synced_until(user_id, mkt_id)
+        if mkt_id is not None:  # a user-wide sync also covers every single market
+            last = max(last, self.synced_until(user_id))
+        after = max(0, last - RESYNC_WINDOW)
+        new_bets = fetch_bets(after, mkt_id)
+        synced_until = max([last] + [b["createdTime"] for b in new_bets])
+        for order_mkt_id, oldest in self.open_orders(user_id, mkt_id).items():
+            if oldest <= after:  # not covered by the fetch above
+                new_bets += fetch_bets(oldest - 1, order_mkt_id)
+        self.add_bets(user_id, new_bets, mkt_id=mkt_id, synced_until=synced_until)
+        return len(new_bets)
+
+    def get_bets(self, user_id, mkt_id=None) -> List[Dict[str, Any]]:
+        """Returns the stored bets of a user (on one market or all markets), newest first like the API."""
+        query, params = "SELECT bet FROM bets WHERE user_id = ?", [user_id]
+        if mkt_id is not None:
+            query, params = query + " AND contract_id = ?", params + [mkt_id]
+        with self._lock:
+            rows = self._conn.execute(query + " ORDER BY created_time DESC", params).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+
+_ledger = None
+_ledger_failed = False
+_ledger_lock = threading.Lock()
+
+
+def get_ledger() -> Optional[BetLedger]:
+    """Returns the shared ledger, or None if it can't be opened (e.g. read-only file system)."""
+    global _ledger, _ledger_failed
+    with _ledger_lock:
+        if _ledger is None and not _ledger_failed:
+            try:
+                _ledger = BetLedger(LEDGER_DB)
+            except (OSError, sqlite3.Error) as e:
+                print(f"Could not open bet ledger {LEDGER_DB}: {e}. Fetching bets from the API instead.")
+                _ledger_failed = True
+        return _ledger
@@ -1,4 +1,5 @@
 import argparse
+import io
 import math
 import random
 import re
@@ -6,13 +7,15 @@ import time
 from datetime import datetime
 
 import pandas as pd
-import requests
 from bs4 import BeautifulSoup
 from tqdm import tqdm
 
+from forecasts import get_forecast_store, page_hash
 from kelly import kelly_manifold
-from manifoldpy import api
-from utils import load_config
+from page_cache import fetch_text
+from resolved import get_resolved_markets
+from transport import PooledAPIWrapper
+from utils import get_balance, get_market_from_manifold, load_config
 
 API_KEY, _ = load_config()
 
@@ -393,17 +396,9 @@ DATA_URL = "https://projects.fivethirtyeight.com/march-madness-api/2023/fivethir
 RESOLVED_MARKETS = "resolved_markets.txt"
 
 
-def read_resolved_markets():
-    """Read which market ids are already resolved from file."""
-    with open(RESOLVED_MARKETS, "r") as f:
-        resolved_markets = f.read().splitlines()
-    return resolved_markets
-
-
-def append_resolved_market(mkt_id):
-    """Append a market id to the file of resolved markets."""
-    with open(RESOLVED_MARKETS, "a") as f:
-        f.write(f"{mkt_id}\n")
+def append_resolved_market(mkt):
+    """Record a market in the store of resolved markets."""
+    get_resolved_markets(RESOLVED_MARKETS).add(mkt.id, close_time=mkt.closeTime, resolution_time=mkt.resolutionTime)
 
 
 def get_538_team_from_q(q):
@@ -414,11 +409,18 @@ def get_538_team_from_q(q):
 
 def download_data(data_url):
     """Downloads a csv file from a url and returns a pandas dataframe."""
-    df = pd.read_csv(data_url, usecols=["gender", "forecast_date", "team_name", "rd7_win"])
+    text = fetch_text(data_url)
+    df = pd.read_csv(io.StringIO(text), usecols=["gender", "forecast_date", "team_name", "rd7_win"])
     df = df[df.gender == "mens"]
     df["forecast_date"] = df["forecast_date"].apply(convert_str_to_date)
     df = keep_only_latest(df)
     assert len(df) == 68
+    store = get_forecast_store()
+    if store is not None:
+        try:
+            store.record(data_url, df.team_name.tolist(), ["rd7_win"], df[["rd7_win"]].to_numpy(), page_hash=page_hash(text))
+        except OSError as e:
+            print(f"Could not record forecast snapshot of {data_url}: {e}")
     return df
 
 
@@ -444,8 +446,7 @@ def get_value_csv(team_538, df):
 
 
 def get_soup(url):
-    r = requests.get(url)
-    return BeautifulSoup(r.text, "html.parser")
+    return BeautifulSoup(fetch_text(url), "html.parser")
 
 
 def get_rows_selenium():
@@ -561,18 +562,18 @@ def make_all_bets(data, wrapper, amount, min_bet, margin, tail, dry_run, use_kel
         return False
 
     mkt_ids = list(DB.keys()) + list(COMBINED_IDS.keys())
-    resolved_markets = read_resolved_markets()
+    resolved_markets = get_resolved_markets(RESOLVED_MARKETS)
     mkt_ids = [m for m in mkt_ids if m not in resolved_markets]
     random.shuffle(mkt_ids)
     print(f"Found {len(mkt_ids)} markets.")
     print("-" * 10)
 
     for mkt_id in tqdm(mkt_ids):
-        mkt = api.get_market(mkt_id)
+        mkt = get_market_from_manifold(mkt_id)
 
         if mkt.isResolved:
             print(f"Market {mkt_id} ({mkt.question[:44]}) resolved. Skipping and adding to resolved list.")
-            append_resolved_market(mkt_id)
+            append_resolved_market(mkt)
             print("-" * 10)
             continue
 
@@ -618,13 +619,8 @@ def make_all_bets(data, wrapper, amount, min_bet, margin, tail, dry_run, use_kel
     return True
 
 
-def get_balance():
-    user = api.get_user_by_name("howtodowtle")
-    return user.balance
-
-
 def main(amount, min_bet, margin, tail, repeat, dry_run, use_kelly, kelly_scale, use_csv, sleep):
-    wrapper = api.APIWrapper(API_KEY)
+    wrapper = PooledAPIWrapper(API_KEY)
     if use_csv:
         print("Using CSV to get data from 538.")
         data = download_data(DATA_URL)
@@ -673,7 +669,9 @@ def parse_args():
     parser.add_argument("-k", "--use-kelly", action="store_true", help="Use Kelly criterion instead of fixed amount.")
     parser.add_argument("-ks", "--kelly-scale", type=float, default=0.1, help="Kelly scale factor. Default: 0.1.")
     parser.add_argument("-c", "--use-csv", action="store_true", help="Use CSV data instead of Selenium.")
-    parser.add_argument("-s", "--sleep", type=int, default=8, help="Sleep time in seconds between bets. Default: 8.")
+    parser.add_argument(
+        "-s", "--sleep", type=int, default=0, help="Extra sleep in seconds between bets (API calls are rate limited). Default: 0."
+    )
     return parser.parse_args()
 
 
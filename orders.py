@@ -0,0 +1,150 @@
+import threading
+from collections import defaultdict, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import *
+
+from utils import place_limit_order, should_bet_position
+
+ORDER_MAX_WORKERS = 4  # orders submitted (and cancelled) concurrently
+
+Order = namedtuple("Order", ["contract_id", "outcome", "amount", "limit_p", "mkt_p"], defaults=[None])
+OrderResult = namedtuple("OrderResult", ["order", "bet", "error"])  # bet: the filled bet or None if no bet was made
+
+
+class OrderExecutor:
+    """Submits limit orders (and cancels what isn't filled) on a pool of threads, `max_workers` at a time,
+    and books the fills in `account` (an `account.Account`).
+
+    Orders in flight count towards the position of their group (from `database`, or the market itself without a group),
+    so concurrent orders can't jointly push a position past `max_shares`: an order whose group already is at the limit,
+    counting the shares the orders in flight may buy, is rejected like `should_bet_position` would reject it.
+    """
+
+    def __init__(self, wrapper, account, database=None, max_shares=None, max_workers=ORDER_MAX_WORKERS, dry_run=False):
+        self.wrapper = wrapper
+        self.account = account
+        self.database = database
+        self.max_shares = max_shares
+        self.dry_run = dry_run
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="order")
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)  # notified when the last order in flight is done
+        self._pending_amount = 0.0
+        self._pending_shares: Dict[str, float] = defaultdict(float)  # exposure group -> max. shares of orders in flight
+        self._in_flight = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+
+    def _exposure_group(self, contract_id) -> Tuple[str, float]:
+        """Returns the group whose position limits the market and the sign of the market's shares in it ("!" markets count negative)."""
+        group = self.database[contract_id]["group"] if self.database is not None and contract_id in self.database else None
+        if group is None:
+            return contract_id, 1.0
+        return group.lstrip("!"), -1.0 if group.startswith("!") else 1.0
+
+    def _position(self, contract_id) -> float:
+        portfolio = self.account.portfolio
+        has_group = self.database is not None and self.database.get(contract_id, {}).get("group") is not None
+        return portfolio.group_shares(contract_id, self.database) if has_group else portfolio.shares(contract_id)
+
+    @staticmethod
+    def _max_order_shares(order: Order) -> float:
+        """Upper bound of the shares an order can buy (all at the current price, or the limit price if unknown)."""
+        p = order.mkt_p if order.mkt_p is not None else order.limit_p
+        price = p if order.outcome == "YES" else 1 - p
+        return order.amount / max(price, 0.01)
+
+    def wait(self):
+        """Blocks until no order is in flight: their fills are booked and the unfilled amounts are free again."""
+        with self._idle:
+            self._idle.wait_for(lambda: self._in_flight == 0)
+
+    def available_balance(self) -> float:
+        """Balance minus the amount of the orders in flight."""
+        with self._lock:
+            return self.account.balance - self._pending_amount
+
+    def submit(self, order: Order) -> "Future[OrderResult]":
+        """Checks the exposure limit and submits the order. Returns a future of its `OrderResult`."""
+        with self._lock:
+            if self._in_flight == 0:
+                self.account.maybe_reconcile()  # only between batches, so that no fill is counted twice
+            group, sign = self._exposure_group(order.contract_id)
+            if self.max_shares is not None:
+                shares = self._position(order.contract_id) + sign * self._pending_shares[group]
+                if not should_bet_position(binary_outcome=order.outcome, shares=shares, max_shares=self.max_shares):
+                    future = Future()
+                    future.set_result(OrderResult(order, None, f"position limit: {shares:.0f} shares in group {group}"))
+                    return future
+            reserved_shares = sign * (1 if order.outcome == "YES" else -1) * self._max_order_shares(order)
+            self._pending_amount += order.amount
+            self._pending_shares[group] += reserved_shares
+            self._in_flight += 1
+        return self._pool.submit(self._execute, order, group, reserved_shares)
+
+    def _execute(self, order: Order, group, reserved_shares) -> OrderResult:
+        bet, error = None, None
+        try:
+            bet = place_limit_order(
+                wrapper=self.wrapper,
+                amount=order.amount,
+                contract_id=order.contract_id,
+                binary_outcome=order.outcome,
+                limit_p=order.limit_p,
+                dry_run=self.dry_run,
+            )
+            if bet is not None:
+                self.account.apply_bet(order.contract_id, order.outcome, bet)
+        except Exception as e:
+            error = str(e)
+            print(f"Order on market {order.contract_id} failed: {e}")
+            self.account.apply_bet(order.contract_id, order.outcome, None)  # unknown fill: reconcile before the next batch
+        finally:
+            with self._lock:
+                self._pending_amount -= order.amount
+                self._pending_shares[group] -= reserved_shares
+                self._in_flight -= 1
+                if self._in_flight == 0:
+                    self._idle.notify_all()
+        return OrderResult(order, bet, error)
+
+    def execute(self, orders: Iterable[Order]) -> List[OrderResult]:
+        """Submits a batch of orders concurrently and waits for all of them. Results are in the order of `orders`."""
+        futures = [self.submit(order) for order in orders]
+        return [future.result() for future in futures]
+
+    def execute_legs(self, legs: Sequence[Order], unwind=False) -> List[OrderResult]:
+        """Places the legs of a trade (e.g. both sides of an arbitrage) concurrently.
+        If some legs got filled and others didn't, `unwind` sells the shares of the filled legs again
+        instead of leaving the position unhedged.
+        """
+        results = self.execute(legs)
+        filled = [r for r in results if is_filled(r)]
+        if unwind and filled and len(filled) < len(results):
+            for result in filled:
+                self._sell(result.order, result.bet["shares"])
+        return results
+
+    def _sell(self, order: Order, shares):
+        print(f"Unwinding: selling {shares:.0f} {order.outcome} shares (mkt {order.contract_id}).")
+        try:
+            r = self.wrapper.sell_shares(order.contract_id, order.outcome, shares)
+            sale = r.json() if r.status_code == 200 else None
+            if sale is None:
+                print(r.status_code, r.text)
+        except Exception as e:
+            print(f"Selling shares of market {order.contract_id} failed: {e}")
+            sale = None
+        self.account.apply_bet(order.contract_id, order.outcome, sale)
+
+
+def is_filled(result: OrderResult) -> bool:
+    """Whether the order bought any shares."""
+    return result.bet is not None and (result.bet.get("shares") or 0) > 0
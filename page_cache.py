@@ -0,0 +1,87 @@
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import requests
+
+import transport
+from utils import CACHE_EXPIRY_PAGES
+
+PAGE_CACHE_DIR = "data/page_cache"
+
+
+def _entry_path(url, cache_dir):
+    """One gzipped json file per url, named by the hash of the url."""
+    return os.path.join(cache_dir, hashlib.sha1(url.encode("utf-8")).hexdigest() + ".json.gz")
+
+
+def read_entry(url, cache_dir=PAGE_CACHE_DIR):
+    """Returns the cached entry for `url` (dict with body, etag, last_modified, fetched_at) or None."""
+    path = _entry_path(url, cache_dir)
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):  # missing or corrupt file
+        return None
+    return entry if entry.get("url") == url else None
+
+
+def write_entry(url, entry, cache_dir=PAGE_CACHE_DIR):
+    """Writes atomically (temp file + rename) so that concurrent runs never read half a file."""
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        with gzip.open(os.fdopen(fd, "wb"), "wt", encoding="utf-8") as f:
+            json.dump(dict(entry, url=url), f)
+        os.replace(tmp_path, _entry_path(url, cache_dir))
+    except OSError as e:  # e.g. read-only file system: still works, just without persistence
+        print(f"Could not write page cache for {url}: {e}")
+
+
+def fetch_text(url, ttl=CACHE_EXPIRY_PAGES, cache_dir=PAGE_CACHE_DIR, timeout=transport.TIMEOUT, verbose=False):
+    """Returns the body of `url`, backed by a compressed on-disk cache that survives between runs.
+
+    - Entries younger than `ttl` seconds are served without touching the network.
+    - Older entries are revalidated with `If-None-Match`/`If-Modified-Since`; a 304 only refreshes the timestamp.
+    - If the server can't be reached, the stale body is served rather than failing the whole run.
+    """
+    entry = read_entry(url, cache_dir)
+    if entry is not None and time.time() - entry["fetched_at"] < ttl:
+        if verbose:
+            print(f"Page cache hit for {url}.")
+        return entry["body"]
+
+    headers = {}
+    if entry is not None:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+    try:
+        r = transport.get(url, headers=headers, timeout=timeout)
+        if r.status_code != 304:
+            r.raise_for_status()
+    except requests.RequestException as e:
+        if entry is None:
+            raise
+        print(f"Could not revalidate {url} ({e}). Using cached page from {time.ctime(entry['fetched_at'])}.")
+        return entry["body"]
+
+    if r.status_code == 304:
+        if verbose:
+            print(f"Page cache revalidated for {url} (not modified).")
+        entry["fetched_at"] = time.time()
+    else:
+        if verbose:
+            print(f"Page cache miss for {url}, downloaded {len(r.content)} bytes.")
+        entry = {
+            "body": r.text,
+            "etag": r.headers.get("ETag"),
+            "last_modified": r.headers.get("Last-Modified"),
+            "fetched_at": time.time(),
+        }
+    write_entry(url, entry, cache_dir)
+    return entry["body"]
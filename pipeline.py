@@ -0,0 +1,47 @@
+import asyncio
+from typing import *
+
+from tqdm import tqdm
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+async def _run_pipeline(items, stage_fn, sink_fn, concurrency, progress):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_stage(item):
+        async with semaphore:
+            return await asyncio.to_thread(stage_fn, item)
+
+    tasks = [asyncio.create_task(run_stage(item)) for item in items]
+    try:
+        for item, task in tqdm(zip(items, tasks), total=len(items), disable=not progress):
+            result = await task
+            keep_going = await asyncio.to_thread(sink_fn, item, result)
+            if keep_going is False:
+                return False
+        return True
+    finally:
+        for task in tasks:
+            task.cancel()  # only affects stages still waiting for the semaphore
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def run_pipeline(
+    items: Sequence[T],
+    stage_fn: Callable[[T], R],
+    sink_fn: Callable[[T, R], Optional[bool]],
+    concurrency=8,
+    progress=True,
+) -> bool:
+    """Runs the blocking `stage_fn(item)` for all items in threads, at most `concurrency` at a time,
+    and feeds the results into `sink_fn(item, result)` one by one in the original order of `items`.
+
+    The sink starts as soon as the first result is ready, so e.g. bets are placed while later markets are still being fetched.
+    Stops (and drops the stages that haven't started) as soon as `sink_fn` returns False.
+    Returns False if stopped early, True otherwise.
+    """
+    assert concurrency >= 1, "Concurrency must be at least 1."
+    items = list(items)
+    return asyncio.run(_run_pipeline(items, stage_fn, sink_fn, concurrency, progress))
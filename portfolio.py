@@ -0,0 +1,69 @@
+from typing import *
+
+import numpy as np
+
+from ledger import get_ledger
+from utils import _get_all_bets_custom, find_group, get_position_value
+
+
+class Portfolio:
+    """Snapshot of all positions (YES - NO shares per market) built from one download of all bets of a user.
+    Answers the same questions as `utils.get_shares`/`utils.get_group_shares` without any further API call.
+    """
+
+    def __init__(self, bets: Iterable[Dict[str, Any]]):
+        bets = list(bets)
+        contract_ids = np.array([b["contractId"] for b in bets], dtype=object)
+        signs = np.array([1.0 if b["outcome"] == "YES" else -1.0 if b["outcome"] == "NO" else 0.0 for b in bets])
+        shares = np.array([b["shares"] or 0.0 for b in bets], dtype=float)
+        self._shares: Dict[str, float] = {}
+        if bets:
+            mkt_ids, idx = np.unique(contract_ids.astype(str), return_inverse=True)
+            totals = np.bincount(idx, weights=signs * shares, minlength=len(mkt_ids))
+            self._shares = dict(zip(mkt_ids.tolist(), totals.tolist()))
+
+    @classmethod
+    def from_user(cls, user_id, verbose=False) -> "Portfolio":
+        """Syncs all bets of the user into the local ledger (only new ones are downloaded) and builds the snapshot.
+        Without a ledger, downloads all bets of the user in one paginated stream.
+        """
+        ledger = get_ledger()
+        if ledger is None:
+            bets = _get_all_bets_custom(userId=user_id)
+        else:
+            ledger.sync(user_id, lambda after, mkt_id: _get_all_bets_custom(userId=user_id, marketId=mkt_id, after=after))
+            bets = ledger.get_bets(user_id)
+        portfolio = cls(bets)
+        if verbose:
+            print(f"Portfolio: {len(bets)} bets in {len(portfolio._shares)} markets.")
+        return portfolio
+
+    def __contains__(self, mkt_id):
+        return mkt_id in self._shares
+
+    def shares(self, mkt_id) -> float:
+        """YES shares - NO shares held in a market (0 if never traded)."""
+        return self._shares.get(mkt_id, 0.0)
+
+    def apply_bet(self, mkt_id, outcome, shares) -> float:
+        """Adds the shares bought (or, if negative, sold) by a new bet. Returns the number of YES/NO share pairs this redeems (M1 each)."""
+        old_shares = self.shares(mkt_id)
+        new_shares = shares if outcome == "YES" else -shares
+        self._shares[mkt_id] = old_shares + new_shares
+        return min(abs(old_shares), shares) if shares > 0 and old_shares * new_shares < 0 else 0.0
+
+    def group_shares(self, mkt_id, database) -> float:
+        same_outcome_mkts, opposite_outcome_mkts = find_group(mkt_id, database)
+        same_outcome_shares = sum(self.shares(mid) for mid in set(same_outcome_mkts) | {mkt_id})
+        opposite_outcome_shares = sum(self.shares(mid) for mid in opposite_outcome_mkts)
+        return same_outcome_shares - opposite_outcome_shares
+
+    def get_shares(self, mkt_id, database) -> Tuple[float, float, bool]:
+        """Same as `utils.get_shares`: (shares in the market, shares in its group, whether it has a group)."""
+        has_group = database[mkt_id]["group"] is not None
+        individual_mkt_shares = self.shares(mkt_id)
+        group_shares = self.group_shares(mkt_id, database) if has_group else individual_mkt_shares
+        return individual_mkt_shares, group_shares, has_group
+
+    def position_value(self, mkt_id, probability) -> float:
+        return get_position_value(self.shares(mkt_id), probability)
@@ -0,0 +1,58 @@
+import threading
+import time
+from typing import *
+
+
+class AdaptiveRateLimiter:
+    """Token bucket whose refill rate adapts to the server (AIMD):
+    the rate is halved on every 429 response and grows back by `increase` requests/s on every successful one.
+    Thread-safe: `acquire` blocks until a token is available.
+    """
+
+    def __init__(self, rate, max_rate, min_rate=0.2, burst=None, decrease=0.5, increase=0.1):
+        assert 0 < min_rate <= rate <= max_rate, "Rates must satisfy 0 < min_rate <= rate <= max_rate."
+        self.rate = rate
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.capacity = burst if burst is not None else max(1.0, rate)
+        self.decrease = decrease
+        self.increase = increase
+        self.throttled = 0  # number of 429s seen
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self._blocked_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = max(self._blocked_until - now, (1 - self._tokens) / self.rate)
+            time.sleep(wait)
+
+    def on_throttled(self, retry_after: Optional[float] = None):
+        with self._lock:
+            self.throttled += 1
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self._tokens = min(self._tokens, 0.0)
+            if retry_after is not None:
+                self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+
+# Manifold allows ~500 requests per minute per IP; bets and cancellations get a separate, smaller budget.
+LIMITERS = {
+    "read": AdaptiveRateLimiter(rate=5.0, max_rate=8.0),
+    "write": AdaptiveRateLimiter(rate=1.0, max_rate=2.0, burst=2),
+}
@@ -0,0 +1,139 @@
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import *
+
+try:
+    import fcntl
+except ImportError:  # Windows: only threads of one process are synchronized
+    fcntl = None
+
+RESOLVED_MARKETS = "data/resolved_markets.txt"
+COMPACT_MIN_LINES = 100  # rewrite the file without duplicates once it has this many lines and
+COMPACT_RATIO = 2  # at least this many lines per distinct market
+
+
+def _parse_time(value) -> Optional[int]:
+    return int(value) if value else None
+
+
+class ResolvedMarkets:
+    """Set of closed/resolved market ids with their close and resolution times (ms since epoch, if known).
+
+    Backed by an append-only text file with one `mkt_id[<TAB>close_time<TAB>resolution_time]` line per market,
+    so old files with bare ids still work. The file is read once; afterwards only lines appended by other processes
+    are read, right before appending under an exclusive file lock. Duplicates are compacted away from time to time.
+    Reading takes no lock, so a read-only store still works (markets added then are only kept in memory).
+    """
+
+    def __init__(self, path=RESOLVED_MARKETS):
+        self.path = path
+        self._times: Dict[str, Tuple[Optional[int], Optional[int]]] = {}
+        self._lines = 0
+        self._offset = 0
+        self._inode = None
+        self._lock = threading.Lock()
+        with self._lock:
+            self._read_new()
+
+    @contextmanager
+    def _file_lock(self):
+        if fcntl is None:
+            yield
+            return
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_new(self):
+        """Reads the lines appended since the last read (everything if the file was compacted in the meantime)."""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        if stat.st_ino != self._inode or stat.st_size < self._offset:
+            self._times, self._lines, self._offset, self._inode = {}, 0, 0, stat.st_ino
+        with open(self.path, "r") as f:
+            f.seek(self._offset)
+            for line in f.read().splitlines():
+                if line.strip():
+                    self._merge(*line.strip().split("\t"))
+                    self._lines += 1
+            self._offset = f.tell()
+
+    def _merge(self, mkt_id, close_time=None, resolution_time=None):
+        old_close_time, old_resolution_time = self._times.get(mkt_id, (None, None))
+        self._times[mkt_id] = (_parse_time(close_time) or old_close_time, _parse_time(resolution_time) or old_resolution_time)
+
+    def add(self, mkt_id, close_time=None, resolution_time=None):
+        """Records a market as closed/resolved (no-op if it is already recorded with the same times)."""
+        with self._lock:
+            try:
+                self._append(mkt_id, close_time, resolution_time)
+            except OSError as e:  # e.g. read-only file system: still works, just without persistence
+                print(f"Could not record resolved market {mkt_id} in {self.path}: {e}")
+                self._merge(mkt_id, close_time, resolution_time)
+
+    def _append(self, mkt_id, close_time, resolution_time):
+        """Appends a line for a market under the file lock (caller holds the thread lock)."""
+        with self._file_lock():
+            self._read_new()
+            old_times = self._times.get(mkt_id)
+            if old_times is not None and (close_time or old_times[0], resolution_time or old_times[1]) == old_times:
+                return
+            times = [str(t) if t else "" for t in (close_time, resolution_time)]
+            line = "\t".join([mkt_id] + times).rstrip("\t")
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "a") as f:
+                f.write(f"{line}\n")
+            self._read_new()
+            if self._lines >= COMPACT_MIN_LINES and self._lines >= COMPACT_RATIO * len(self._times):
+                self._compact()
+
+    def _compact(self):
+        """Rewrites the file with one line per market (caller holds both locks)."""
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or ".", suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            for mkt_id, times in self._times.items():
+                f.write("\t".join([mkt_id] + [str(t) if t else "" for t in times]).rstrip("\t") + "\n")
+        os.replace(tmp_path, self.path)
+        self._inode = None
+        self._read_new()
+
+    def __contains__(self, mkt_id):
+        return mkt_id in self._times
+
+    def __iter__(self):
+        return iter(list(self._times))
+
+    def __len__(self):
+        return len(self._times)
+
+    def close_time(self, mkt_id) -> Optional[int]:
+        return self._times.get(mkt_id, (None, None))[0]
+
+    def resolution_time(self, mkt_id) -> Optional[int]:
+        return self._times.get(mkt_id, (None, None))[1]
+
+    def closed_before(self, time_ms) -> Set[str]:
+        """Ids of markets that closed or resolved before the given time (ms since epoch), for prefiltering."""
+        return {mid for mid, times in self._times.items() if any(t is not None and t < time_ms for t in times)}
+
+
+_stores: Dict[str, ResolvedMarkets] = {}
+_stores_lock = threading.Lock()
+
+
+def get_resolved_markets(path=RESOLVED_MARKETS) -> ResolvedMarkets:
+    """Returns the shared store for a file, loading it on first use."""
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = ResolvedMarkets(path)
+        return _stores[path]
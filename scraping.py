@@ -1,12 +1,18 @@
 import bisect
-import itertools as it
-from typing import Iterable
+import hashlib
+import inspect
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Iterable, Set
 
 import numpy as np
-import requests
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, FeatureNotFound, SoupStrainer
 
-from utils import CACHE_EXPIRY_SCRAPING, cache_with_expiry
+from forecasts import get_forecast_store, page_hash
+from page_cache import fetch_text
+from utils import CACHE_EXPIRY_SCRAPING, TTLCache, cache_with_expiry
 
 NBA_TEAMS_538 = {  # as used by 538
     "ATL",
@@ -53,6 +59,9 @@ LEAGUE_LENGTHS = {
     "La Liga": 20,
 }
 
+NBA_URL = "https://projects.fivethirtyeight.com/2023-nba-predictions"
+NHL_URL = "https://projects.fivethirtyeight.com/2023-nhl-predictions/"
+
 CUP_URLS = {
     "Champions League": "https://projects.fivethirtyeight.com/soccer-predictions/champions-league/",
     "Europa League": "https://projects.fivethirtyeight.com/soccer-predictions/europa-league/",
@@ -60,11 +69,115 @@ CUP_URLS = {
     "MLS": "https://projects.fivethirtyeight.com/soccer-predictions/mls/",
 }
 
+CUP_STAGES = ("make_playoffs", "make_round_one", "last_sixteen", "quarters", "semis", "finals", "win")
+
+# stage -> (class of its cells in a team row, which of the cells with that class), per cup page
+CUP_STAGE_COLUMNS = {
+    "Champions League": {
+        "last_sixteen": ("pct border-left champ drop-4", 0),
+        "quarters": ("pct champ-quarters", 0),
+        "semis": ("pct champ", 0),
+        "finals": ("pct champ drop-7", 0),
+        "win": ("pct champ champ-win", 0),
+    },
+    "Europa League": {
+        "knockout": ("pct border-left champ drop-3", 0),
+        "last_sixteen": ("pct champ drop-4", 0),
+        "quarters": ("pct champ-quarters", 0),
+        "semis": ("pct champ", 0),
+        "finals": ("pct champ drop-7", 0),
+        "win": ("pct champ champ-win", 0),
+    },
+    "Conference League": {
+        # "knockout": ("pct border-left champ drop-3", 0),
+        # "last_sixteen": ("pct champ drop-4", 0),
+        # "quarters": ("pct champ-quarters", 0),  # untested
+        "semis": ("pct champ", 0),
+        "finals": ("pct champ drop-7", 0),
+        "win": ("pct champ champ-win", 0),
+    },
+    "MLS": {
+        "make_playoffs": ("pct mls", 0),
+        "make_round_one": ("pct drop-5 mls", 0),
+        "win": ("pct mls", -1),
+    },
+}
+
 
-@cache_with_expiry(seconds=CACHE_EXPIRY_SCRAPING, verbose=False)  # cache for this amount, otherwise call again
-def get_soup(url):
-    r = requests.get(url)
-    return BeautifulSoup(r.text, "html.parser")
+def _fastest_html_parser(candidates=("lxml", "html.parser")):
+    """Returns the first installed BeautifulSoup parser backend (lxml is several times faster than html.parser)."""
+    for parser in candidates:
+        try:
+            BeautifulSoup("", parser)
+            return parser
+        except FeatureNotFound:
+            continue
+    return "html.parser"
+
+
+HTML_PARSER = _fastest_html_parser()
+TABLE_ROWS = SoupStrainer("tr")  # all values we read live in table rows (data-str, data-team, odds/pct cells)
+
+
+def make_soup(html, rows_only=True, parser=None):
+    """Parses `html` with `HTML_PARSER`. With `rows_only`, only `<tr>` elements (and their cells) are materialized."""
+    return BeautifulSoup(html, parser or HTML_PARSER, parse_only=TABLE_ROWS if rows_only else None)
+
+
+# cache for this amount, otherwise call again
+@cache_with_expiry(seconds=CACHE_EXPIRY_SCRAPING, maxsize=16, normalize_args=True, verbose=False)
+def get_soup(url, rows_only=True):
+    return make_soup(fetch_text(url), rows_only=rows_only)
+
+
+def _names_and_strings(code, seen):
+    """Collects global names and string constants used by `code`, following nested code objects
+    and functions of this module that it calls (e.g. `english_team_2_oo_3` -> `get_cup_stage`).
+    Strings inside the getters that look up `LEAGUE_URLS`/`CUP_URLS` are ignored: there, the caller's arguments decide the page.
+    """
+    names = set(code.co_names)
+    strings = set() if names & {"LEAGUE_URLS", "CUP_URLS"} else {c for c in code.co_consts if isinstance(c, str)}
+    nested = [c for c in code.co_consts if isinstance(c, types.CodeType)]
+    nested += [
+        inspect.unwrap(globals()[n]).__code__ for n in code.co_names if isinstance(globals().get(n), types.FunctionType) and n not in seen
+    ]
+    for c in nested:
+        seen.add(c.co_name)
+        n, s = _names_and_strings(c, seen)
+        names |= n
+        strings |= s
+    return names, strings
+
+
+def get_urls_for_mkt_fn(mkt_fn: Callable) -> Set[str]:
+    """Returns the 538 pages a `mkt_fn` from the DB (e.g. `lambda: get_nhl_value("bruins")`) will download."""
+    names, strings = _names_and_strings(mkt_fn.__code__, seen=set())
+    urls = {LEAGUE_URLS[s] for s in strings if s in LEAGUE_URLS} | {CUP_URLS[s] for s in strings if s in CUP_URLS}
+    if "NBA_URL" in names:
+        urls.add(NBA_URL)
+    if "NHL_URL" in names:
+        urls.add(NHL_URL)
+    return urls
+
+
+def prefetch_pages(urls: Iterable[str], max_workers=4, verbose=False):
+    """Downloads and parses `urls` concurrently so that later lookups are cache hits.
+    Pages with a parsed table (see `PAGE_LOADERS`) are loaded into that table, all others into `get_soup`.
+    """
+    urls = sorted(set(urls))
+    if not urls:
+        return
+
+    def fetch(url):
+        try:
+            PAGE_LOADERS.get(url, get_soup)(url)
+        except Exception as e:  # the betting loop will retry and report per market
+            print(f"Error prefetching {url}: {e}")
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(urls))) as executor:
+        list(executor.map(fetch, urls))
+    if verbose:
+        print(f"Prefetched {len(urls)} pages: {urls}")
 
 
 def seed_1_2_upset_23():
@@ -102,87 +215,67 @@ def english_team_2_oo_3(includes_all_three=True):
 def get_position_distribution_efficient(team_name, league_name):
     """Returns a probability distribution of the team's position in the league."""
     assert league_name in LEAGUE_URLS, f"League name must be one of {LEAGUE_URLS.keys()}"
-    league_soup = get_soup(LEAGUE_URLS[league_name])
-    team_row = league_soup.find("tr", {"data-str": team_name})
-    position_dict = get_position_dict_from_team_row(team_row)
-    p_dist = np.array([position_dict[pos] for pos in sorted(position_dict)])
-    assert np.isclose(sum(p_dist), 1, atol=1e-4), f"Values in distribution don't sum to 1: {p_dist}"
-    return p_dist / sum(p_dist)
+    return get_league_forecast(LEAGUE_URLS[league_name]).distribution(team_name)
 
 
 def analytical_who_higher(dist_hi, dist_lo):
     """Returns the probability that the first team is higher in the table (=lower number) than the second team."""
     assert len(dist_hi) == len(dist_lo), f"Distribution lengths must be equal, got {len(dist_hi)} and {len(dist_lo)}"
-    outcomes = range(len(dist_hi))
-    higher = sum(dist_hi[i] * dist_lo[j] for i, j in it.product(outcomes, repeat=2) if i < j)
-    lower = sum(dist_hi[i] * dist_lo[j] for i, j in it.product(outcomes, repeat=2) if j < i)
+    dist_hi, dist_lo = np.asarray(dist_hi, dtype=float), np.asarray(dist_lo, dtype=float)
+    cum_lo = np.cumsum(dist_lo)
+    higher = dist_hi @ (cum_lo[-1] - cum_lo)  # P(lo ends up below position i)
+    lower = dist_hi @ (cum_lo - dist_lo)  # P(lo ends up above position i)
     result = higher / (higher + lower)  # ignore ties, they are impossible
     return result
 
 
+def who_higher_matrix(position_matrix) -> np.ndarray:
+    """`analytical_who_higher` for all pairs of rows of a teams x positions matrix at once:
+    entry [a, b] is the probability that team a finishes above team b (NaN on the diagonal).
+    """
+    position_matrix = np.asarray(position_matrix, dtype=float)
+    cum = np.cumsum(position_matrix, axis=1)
+    higher = position_matrix @ (cum[:, -1:] - cum).T
+    lower = position_matrix @ (cum - position_matrix).T
+    with np.errstate(divide="ignore", invalid="ignore"):
+        result = higher / (higher + lower)
+    np.fill_diagonal(result, np.nan)
+    return result
+
+
+_WHO_HIGHER_TABLES = TTLCache(seconds=60 * 60 * 24, maxsize=8)  # forecast version -> TeamTable
+
+
+def get_who_higher_table(league_name) -> "TeamTable":
+    """Teams x teams table of the probabilities that the row team finishes above the column team.
+    Computed once per forecast version: as long as the position probabilities don't change, it is reused.
+    """
+    assert league_name in LEAGUE_URLS, f"League name must be one of {LEAGUE_URLS.keys()}"
+    forecast = get_league_forecast(LEAGUE_URLS[league_name])
+    table = _WHO_HIGHER_TABLES.get(forecast.version)
+    if table is None:
+        table = TeamTable(forecast.teams, forecast.teams, who_higher_matrix(forecast.distributions()))
+        _WHO_HIGHER_TABLES.set(forecast.version, table)
+    return table
+
+
 def who_higher(team_hi, team_lo, league_name):
-    # NB: getting the distribution is slow but the simulation is fast, high n is OK (tested 1e6)
-    dist_hi = get_position_distribution_efficient(team_hi, league_name)
-    dist_lo = get_position_distribution_efficient(team_lo, league_name)
-    return analytical_who_higher(dist_hi, dist_lo)
+    return get_who_higher_table(league_name).get(team_hi, team_lo)
 
 
 def get_cup_stage(team_name, cup_name, value_name):
     """only tested for champions league"""
-    value_names = ("make_playoffs", "make_round_one", "last_sixteen", "quarters", "semis", "finals", "win")
-    assert value_name in value_names, f"Value name must be one of {value_names}"
+    assert value_name in CUP_STAGES, f"Value name must be one of {CUP_STAGES}"
     assert cup_name in CUP_URLS, f"Cup name must be one of {CUP_URLS.keys()}"
-    value_map = {
-        "Champions League": {
-            "last_sixteen": "pct border-left champ drop-4",
-            "quarters": "pct champ-quarters",
-            "semis": "pct champ",
-            "finals": "pct champ drop-7",
-            "win": "pct champ champ-win",
-        },
-        "Europa League": {
-            "knockout": "pct border-left champ drop-3",
-            "last_sixteen": "pct champ drop-4",
-            "quarters": "pct champ-quarters",
-            "semis": "pct champ",
-            "finals": "pct champ drop-7",
-            "win": "pct champ champ-win",
-        },
-        "Conference League": {
-            # "knockout": "pct border-left champ drop-3",
-            # "last_sixteen": "pct champ drop-4",
-            # "quarters": "pct champ-quarters",  # untested
-            "semis": "pct champ",
-            "finals": "pct champ drop-7",
-            "win": "pct champ champ-win",
-        },
-        "MLS": {
-            "make_playoffs": "pct mls",
-            "make_round_one": "pct drop-5 mls",
-            "win": "pct mls",
-        },
-    }
-    soup = get_soup(CUP_URLS[cup_name])
-    team_row = soup.find("tr", {"data-str": team_name})
-    val_to_look_up = value_map[cup_name][value_name]
-    if cup_name == "MLS" and value_name == "make_playoffs":
-        val = float(team_row.find_all("td", {"class": val_to_look_up})[0]["data-val"])
-    elif cup_name == "MLS" and value_name == "win":
-        val = float(team_row.find_all("td", {"class": val_to_look_up})[-1]["data-val"])
-    else:
-        val = float(team_row.find("td", {"class": val_to_look_up})["data-val"])
+    val = get_cup_table(CUP_URLS[cup_name]).get(team_name, value_name)
     assert 0 <= val <= 1, f"Value must be between 0 and 1. Received {val}."
     return val
 
 
 def get_league_rel_cl_win(team_name, league_name, value_name):
-    value_names = ("rel", "cl", "win")
-    assert value_name in value_names, f"Value name must be one of {value_names}"
+    assert value_name in LEAGUE_VALUES, f"Value name must be one of {LEAGUE_VALUES}"
     assert league_name in LEAGUE_URLS, f"League name must be one of {LEAGUE_URLS.keys()}"
-    soup = get_soup(LEAGUE_URLS[league_name])
-    team_row = soup.find("tr", {"data-str": team_name})
-    rel, cl, win = [float(x["data-val"]) for x in team_row.find_all("td", {"class": "pct"})]
-    val = locals()[value_name]
+    val = get_league_forecast(LEAGUE_URLS[league_name]).values.get(team_name, value_name)
     assert 0 <= val <= 1, f"Value must be between 0 and 1. Received {val}."
     return val
 
@@ -196,14 +289,11 @@ def get_position_dict_from_team_row(team_row):
 
 def get_league_pos(team_name, league_name, positions):
     assert league_name in LEAGUE_URLS, f"League name must be one of {LEAGUE_URLS.keys()}"
-    soup = get_soup(LEAGUE_URLS[league_name])
     # if positions has length 1, convert to list
     if not isinstance(positions, Iterable):
         positions = [positions]
-    team_row = soup.find("tr", {"data-str": team_name})
-    position_dict = get_position_dict_from_team_row(team_row)
     # return the sum of the probabilities of the positions we are interested in
-    val = sum(position_dict[p] for p in positions)
+    val = float(get_league_forecast(LEAGUE_URLS[league_name]).position_probability(positions, [team_name])[0])
     assert 0 <= val <= 1, f"Value must be between 0 and 1. Received {val}."
     return val
 
@@ -223,37 +313,247 @@ def find_closest_strings(input_string, string_list):
         return sorted_list_original[:3]
 
 
+class TeamTable:
+    """Team x value matrix parsed once from a 538 page, so that every lookup is a dict access plus an array index.
+    Values that could not be parsed are NaN.
+    """
+
+    def __init__(self, teams, columns, values):
+        self.teams = list(teams)
+        self.columns = tuple(columns)
+        self.values = np.asarray(values, dtype=float).reshape(len(self.teams), len(self.columns))
+        self._team_idx = {team: i for i, team in enumerate(self.teams)}
+        self._column_idx = {column: j for j, column in enumerate(self.columns)}
+
+    def __contains__(self, team):
+        return team in self._team_idx
+
+    def __len__(self):
+        return len(self.teams)
+
+    def get(self, team, column) -> float:
+        return float(self.values[self._team_idx[team], self._column_idx[column]])
+
+    def column(self, column) -> np.ndarray:
+        return self.values[:, self._column_idx[column]]
+
+    def rows(self, teams) -> np.ndarray:
+        return self.values[[self._team_idx[team] for team in teams]]
+
+
+_replay_time = None  # seconds since epoch, see `replay_forecasts`
+
+
+def _replayed_table(url, t) -> TeamTable:
+    store = get_forecast_store()
+    snapshot = store.as_of(url, t) if store is not None else None
+    if snapshot is None:
+        raise LookupError(f"No forecast snapshot of {url} as of {time.ctime(t)}.")
+    return TeamTable(snapshot.teams, snapshot.columns, snapshot.values)
+
+
+@contextmanager
+def replay_forecasts(t):
+    """Within the block, the page loaders (and everything built on them, e.g. the `mkt_fn`s of the DB) return the forecasts
+    as they were stored at time `t` (seconds since epoch) instead of downloading the pages. Not thread-safe.
+    """
+    global _replay_time
+    for loader in set(PAGE_LOADERS.values()):
+        loader.cache_clear()
+    _replay_time = t
+    try:
+        yield
+    finally:
+        _replay_time = None
+        for loader in set(PAGE_LOADERS.values()):
+            loader.cache_clear()
+
+
+def _load_table(url, parse: Callable) -> TeamTable:
+    """Returns the table of a page: from the latest snapshot in the forecast store if this page was parsed into it before,
+    otherwise parsed with `parse(soup, url)` and recorded (a new snapshot if the values changed).
+    """
+    if _replay_time is not None:
+        return _replayed_table(url, _replay_time)
+    text = fetch_text(url)
+    store = get_forecast_store()
+    text_hash = page_hash(text)
+    snapshot = store.latest_for_page(url, text_hash) if store is not None else None
+    if snapshot is not None:
+        return TeamTable(snapshot.teams, snapshot.columns, snapshot.values)
+    table = parse(make_soup(text), url)
+    if store is not None:
+        try:
+            store.record(url, table.teams, table.columns, table.values, page_hash=text_hash)
+        except OSError as e:  # still works, just without history
+            print(f"Could not record forecast snapshot of {url}: {e}")
+    return table
+
+
+LEAGUE_VALUES = ("rel", "cl", "win")  # the three "pct" cells of a league table row: relegation, Champions League, title
+
+
+class LeagueForecast:
+    """Forecast of a soccer league, parsed once from its page: a teams x positions (1 ... league length) probability
+    matrix and the relegation/Champions League/title probabilities of every team. `version` is a hash of the content.
+    """
+
+    def __init__(self, league_name, teams, position_values, values):
+        n_teams = LEAGUE_LENGTHS[league_name]
+        assert len(teams) == n_teams, f"{league_name} has {n_teams} teams, parsed {len(teams)}: {list(teams)}"
+        self.league_name = league_name
+        self.positions = TeamTable(teams, range(1, n_teams + 1), position_values)
+        self.values = TeamTable(teams, LEAGUE_VALUES, values)
+        content = self.positions.values.tobytes() + self.values.values.tobytes() + "\n".join(self.teams).encode()
+        self.version = hashlib.sha1(content).hexdigest()
+
+    @property
+    def teams(self):
+        return self.positions.teams
+
+    def __contains__(self, team):
+        return team in self.positions
+
+    def _rows(self, teams=None):
+        return self.positions.values if teams is None else self.positions.rows(teams)
+
+    def distributions(self, teams=None) -> np.ndarray:
+        """Position distributions (rows normalized to 1) of `teams` (default: all, in the order of `self.teams`)."""
+        rows = self._rows(teams)
+        sums = rows.sum(axis=1, keepdims=True)
+        assert np.allclose(sums, 1, atol=1e-4), f"Values in distributions don't sum to 1: {sums.ravel()}"
+        return rows / sums
+
+    def distribution(self, team) -> np.ndarray:
+        return self.distributions([team])[0]
+
+    def position_probability(self, positions: Iterable[int], teams=None) -> np.ndarray:
+        """P(final position in `positions`) for each of `teams` (default: all), e.g. `range(1, 5)` for the top four."""
+        positions = list(positions)
+        assert all(1 <= p <= len(self.positions.columns) for p in positions), f"Positions must be in 1 ... {len(self.positions.columns)}"
+        return self._rows(teams)[:, np.array(positions, dtype=int) - 1].sum(axis=1)
+
+
+def _page_name(url, urls) -> str:
+    """Name of a page in `LEAGUE_URLS`/`CUP_URLS`."""
+    return next(name for name, page_url in urls.items() if page_url == url)
+
+
+def _parse_league_table(soup, url) -> TeamTable:
+    """Teams x (positions 1 ... league length, then `LEAGUE_VALUES`) table of a league page."""
+    n_teams = LEAGUE_LENGTHS[_page_name(url, LEAGUE_URLS)]
+    team_rows = {}
+    for row in soup.find_all("tr", {"data-str": True}):
+        if row.find("td", {"class": "position-dist"}) is not None:
+            team_rows.setdefault(row["data-str"], row)
+    teams = list(team_rows)
+    values = np.zeros((len(teams), n_teams + len(LEAGUE_VALUES)))
+    for i, team in enumerate(teams):
+        for pos, p in get_position_dict_from_team_row(team_rows[team]).items():
+            assert 1 <= pos <= n_teams, f"Position {pos} of {team} outside of 1 ... {n_teams}"
+            values[i, pos - 1] = p
+        values[i, n_teams:] = np.nan
+        pct_tags = team_rows[team].find_all("td", {"class": "pct"})
+        if len(pct_tags) == len(LEAGUE_VALUES):
+            for j, pct_tag in enumerate(pct_tags):
+                try:
+                    values[i, n_teams + j] = float(pct_tag["data-val"])
+                except (KeyError, ValueError):  # stays NaN, reported on lookup
+                    continue
+    return TeamTable(teams, tuple(range(1, n_teams + 1)) + LEAGUE_VALUES, values)
+
+
+@cache_with_expiry(seconds=CACHE_EXPIRY_SCRAPING, maxsize=8, normalize_args=True, verbose=False)
+def get_league_forecast(url) -> LeagueForecast:
+    league_name = _page_name(url, LEAGUE_URLS)
+    n_teams = LEAGUE_LENGTHS[league_name]
+    table = _load_table(url, _parse_league_table)
+    return LeagueForecast(league_name, table.teams, table.values[:, :n_teams], table.values[:, n_teams:])
+
+
+def _parse_cup_table(soup, url) -> TeamTable:
+    """Teams x stages table of a cup page (stages of `CUP_STAGE_COLUMNS`)."""
+    stage_columns = CUP_STAGE_COLUMNS[_page_name(url, CUP_URLS)]
+    team_rows = {}
+    for row in soup.find_all("tr", {"data-str": True}):
+        team_rows.setdefault(row["data-str"], row)
+    teams = list(team_rows)
+    values = np.full((len(teams), len(stage_columns)), np.nan)
+    for i, team in enumerate(teams):
+        for j, (css_class, index) in enumerate(stage_columns.values()):
+            tds = team_rows[team].find_all("td", {"class": css_class})
+            try:
+                values[i, j] = float(tds[index]["data-val"])
+            except (IndexError, KeyError, ValueError):  # stays NaN, reported on lookup
+                continue
+    return TeamTable(teams, stage_columns, values)
+
+
+@cache_with_expiry(seconds=CACHE_EXPIRY_SCRAPING, maxsize=8, normalize_args=True, verbose=False)
+def get_cup_table(url) -> TeamTable:
+    return _load_table(url, _parse_cup_table)
+
+
+NBA_VALUES = ("make_playoffs", "make_conf_semis", "make_conf_finals", "make_finals", "win_finals")
+NHL_VALUES = ("make_conf_final", "make_final", "win")
+
+
+def _parse_nba_cell(td):
+    text = td.text.strip()
+    if text == "✓" or text.startswith(">"):
+        return 1.0
+    elif text == "—" or text.startswith("<"):
+        return 0.0
+    data_val = td["data-val"]
+    if data_val == "null":  # reading from string
+        return float(text.replace("%", "")) / 100
+    else:
+        val = float(data_val) * 1e-12  # * 1e-12 was changed 2023_04_11
+    # if value_name == "make_playoffs":
+    #     val *= 1
+    # elif value_name == "make_finals":
+    #     val *= 1e-12  # until shortly before playoffs
+    # elif value_name == "win_finals":
+    #     val *= 1e-16  # until shortly before playoffs
+    assert 0 <= val <= 1, f"Value must be between 0 and 1. Received {val}."
+    return val
+
+
+def _parse_nba_table(soup, url) -> TeamTable:
+    team_rows, eliminated_rows = {}, {}
+    for row in soup.find_all("tr", {"data-team": True}):
+        team = row["data-team"]
+        if row.get("class") is None:  # ignores team rows from live games
+            team_rows.setdefault(team, row)
+        elif "eliminated" in row["class"]:
+            eliminated_rows.setdefault(team, row)
+    teams = sorted(set(team_rows) | set(eliminated_rows))
+    values = np.full((len(teams), len(NBA_VALUES)), np.nan)
+    for i, team in enumerate(teams):
+        row = team_rows.get(team, eliminated_rows.get(team))
+        for j, value_name in enumerate(NBA_VALUES):
+            td = row.find("td", {"data-col": value_name})  # was data-cell until 2023_04_11
+            try:
+                values[i, j] = _parse_nba_cell(td)
+            except Exception:  # stays NaN, reported on lookup
+                continue
+    return TeamTable(teams, NBA_VALUES, values)
+
+
+@cache_with_expiry(seconds=CACHE_EXPIRY_SCRAPING, maxsize=4, normalize_args=True, verbose=False)
+def get_nba_table(url=NBA_URL) -> TeamTable:
+    return _load_table(url, _parse_nba_table)
+
+
 def get_nba_value(team_name, value_name):
     assert (
         team_name in NBA_TEAMS_538
     ), f"Team name must fit 538 list.\
         Received {team_name}; could it be one of {find_closest_strings(team_name, NBA_TEAMS_538)}?"
     try:
-        nba_url = "https://projects.fivethirtyeight.com/2023-nba-predictions"
-        soup = get_soup(nba_url)
-        VALUES = ("make_playoffs", "make_conf_semis", "make_conf_finals", "make_finals", "win_finals")
-        assert value_name in VALUES, f"Value name must be one of {VALUES}"
-        team_row = soup.find("tr", {"class": None, "data-team": team_name})  # "class": None -> ignores team rows from live games
-        if team_row is None:
-            team_row = soup.find("tr", {"class": "eliminated", "data-team": team_name})
-        td = team_row.find("td", {"data-col": value_name})  # was data-cell until 2023_04_11
-        text = td.text.strip()
-        if text == "✓" or text.startswith(">"):
-            return 1.0
-        elif text == "—" or text.startswith("<"):
-            return 0.0
-        data_val = td["data-val"]
-        if data_val == "null":  # reading from string
-            return float(text.replace("%", "")) / 100
-        else:
-            val = float(data_val) * 1e-12  # * 1e-12 was changed 2023_04_11
-        # if value_name == "make_playoffs":
-        #     val *= 1
-        # elif value_name == "make_finals":
-        #     val *= 1e-12  # until shortly before playoffs
-        # elif value_name == "win_finals":
-        #     val *= 1e-16  # until shortly before playoffs
-        assert 0 <= val <= 1, f"Value must be between 0 and 1. Received {val}."
+        assert value_name in NBA_VALUES, f"Value name must be one of {NBA_VALUES}"
+        val = get_nba_table(NBA_URL).get(team_name, value_name)
+        assert not np.isnan(val), f"Could not parse {value_name} for {team_name}."
         return val
     except Exception as e:
         print(f"Error getting value {value_name} for team {team_name}")
@@ -261,39 +561,48 @@ def get_nba_value(team_name, value_name):
         return None
 
 
-def get_nhl_value(team_name, value_name="win"):
-    assert value_name in (
-        "make_conf_final",
-        "make_final",
-        "win",
-    ), f"Value name must be one of ('make_conf_final', 'make_final', 'win'), got {value_name}"
-    nhl_url = "https://projects.fivethirtyeight.com/2023-nhl-predictions/"
-    soup = get_soup(nhl_url)
-    rows = soup.find_all("tr")
-    team_row = None
-    for row in rows:
+def _parse_nhl_table(soup, url) -> TeamTable:
+    team_rows = {}
+    for row in soup.find_all("tr"):
         name_tag = row.find("td", {"class": "name"})
-        if name_tag is None:
+        if name_tag is None or name_tag.get("data-val") is None:
+            continue
+        team_rows.setdefault(name_tag.get("data-val"), row)
+    teams = list(team_rows)
+    values = np.full((len(teams), len(NHL_VALUES)), np.nan)
+    for i, team in enumerate(teams):
+        value_tags = team_rows[team].find_all("td", {"class": "odds"})[-len(NHL_VALUES) :]  # last three: conf final, final, win
+        if len(value_tags) < len(NHL_VALUES):
             continue
-        if name_tag.get("data-val") == team_name.lower():
-            team_row = row
-            break
-    if team_row is None:
+        for j, value_tag in enumerate(value_tags):
+            try:
+                val = float(value_tag.get("data-val"))
+            except (TypeError, ValueError):  # stays NaN, reported on lookup
+                continue
+            values[i, j] = 0.0 if val == -1.0 else val  # -1.0: missed playoffs
+    return TeamTable(teams, NHL_VALUES, values)
+
+
+@cache_with_expiry(seconds=CACHE_EXPIRY_SCRAPING, maxsize=4, normalize_args=True, verbose=False)
+def get_nhl_table(url=NHL_URL) -> TeamTable:
+    return _load_table(url, _parse_nhl_table)
+
+
+def get_nhl_value(team_name, value_name="win"):
+    assert value_name in NHL_VALUES, f"Value name must be one of {NHL_VALUES}, got {value_name}"
+    table = get_nhl_table(NHL_URL)
+    if team_name.lower() not in table:
         print("Row not found for team:", team_name)
         return None
-
-    def get_value_idx(value_name):
-        if value_name == "make_conf_final":
-            return -3
-        elif value_name == "make_final":
-            return -2
-        elif value_name == "win":
-            return -1
-
-    value_tag = team_row.find_all("td", {"class": "odds"})[get_value_idx(value_name)]
-    value = value_tag.get("data-val")
-    val = float(value)
-    if val == -1.0:  # missed playoffs
-        val = 0.0
+    val = table.get(team_name.lower(), value_name)
     assert 0 <= val <= 1, f"Value must be between 0 and 1. Received {val}."
     return val
+
+
+# pages that are parsed into compact tables instead of being kept as soup
+PAGE_LOADERS = {
+    NBA_URL: get_nba_table,
+    NHL_URL: get_nhl_table,
+    **{url: get_league_forecast for url in LEAGUE_URLS.values()},
+    **{url: get_cup_table for url in CUP_URLS.values()},
+}
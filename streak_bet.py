@@ -1,6 +1,6 @@
 import argparse
 
-from manifoldpy import api
+from transport import PooledAPIWrapper
 from utils import bet_using_market_probabilities, load_config
 
 API_KEY, _ = load_config()
@@ -24,7 +24,7 @@ def main():
     mkt_id = args.market_id
     amount = args.amount
 
-    wrapper = api.APIWrapper(api_key)
+    wrapper = PooledAPIWrapper(api_key)
     bet_using_market_probabilities(mkt_id=mkt_id, amount=amount, wrapper=wrapper)
 
 
@@ -0,0 +1,125 @@
+import threading
+import time
+from typing import *
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from manifoldpy import api
+from rate_limit import LIMITERS, AdaptiveRateLimiter
+
+TIMEOUT = (5, 20)  # (connect, read) in seconds
+RETRIES = 3
+BACKOFF_FACTOR = 0.5  # sleeps 0.5, 1, 2, ... s between retries (or whatever `Retry-After` says)
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+POOL_SIZE = 16  # connections kept alive per host
+RATE_LIMITED_HOSTS = ("manifold.markets",)  # 429s from these are handled here (adaptive rate limit), not by urllib3
+
+# one pooled, keep-alive session per host: 538 scraping and the Manifold API pay the TLS handshake once
+_sessions: Dict[str, requests.Session] = {}
+_sessions_lock = threading.Lock()
+
+
+def _make_session(host: str) -> requests.Session:
+    # NB: POST is deliberately not retried (urllib3's default allowed methods) so a bet is never placed twice.
+    retry = Retry(
+        total=RETRIES,
+        backoff_factor=BACKOFF_FACTOR,
+        status_forcelist=[s for s in RETRY_STATUSES if not (s == 429 and host in RATE_LIMITED_HOSTS)],
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({"Accept-Encoding": "gzip, deflate", "Connection": "keep-alive"})
+    return session
+
+
+def get_session(url: str) -> requests.Session:
+    """Returns the pooled session for the host of `url` (created on first use)."""
+    host = urlsplit(url).netloc
+    with _sessions_lock:
+        if host not in _sessions:
+            _sessions[host] = _make_session(host)
+        return _sessions[host]
+
+
+def close_sessions():
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def get_limiter(method: str, url: str) -> Optional[AdaptiveRateLimiter]:
+    """Reads and writes (bets, cancellations) to rate-limited hosts have separate budgets."""
+    if urlsplit(url).netloc not in RATE_LIMITED_HOSTS:
+        return None
+    return LIMITERS["read" if method.upper() == "GET" else "write"]
+
+
+def _retry_after(response, attempt) -> float:
+    try:
+        return float(response.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return BACKOFF_FACTOR * 2**attempt
+
+
+def _rate_limited(method: str, url: str, do_request: Callable[[], requests.Response]) -> requests.Response:
+    """Waits for the rate limiter before each attempt and retries 429s (a throttled request was not executed,
+    so this is safe for bets too). Every 429 slows the limiter down, every success speeds it up again.
+    """
+    limiter = get_limiter(method, url)
+    if limiter is None:
+        return do_request()
+    for attempt in range(RETRIES + 1):
+        limiter.acquire()
+        r = do_request()
+        if r.status_code != 429:
+            limiter.on_success()
+            return r
+        retry_after = _retry_after(r, attempt)
+        limiter.on_throttled(retry_after)
+        if attempt < RETRIES:
+            time.sleep(retry_after)
+    return r
+
+
+def get(url: str, params=None, headers=None, timeout=TIMEOUT) -> requests.Response:
+    return _rate_limited("GET", url, lambda: get_session(url).get(url, params=params, headers=headers, timeout=timeout))
+
+
+def post(url: str, json=None, headers=None, timeout=TIMEOUT) -> requests.Response:
+    return _rate_limited("POST", url, lambda: get_session(url).post(url, json=json, headers=headers, timeout=timeout))
+
+
+def send(prepped: requests.PreparedRequest, timeout=TIMEOUT) -> requests.Response:
+    return _rate_limited(prepped.method, prepped.url, lambda: get_session(prepped.url).send(prepped, timeout=timeout))
+
+
+def get_json(url: str, params=None, timeout=TIMEOUT) -> Any:
+    r = get(url, params=params, timeout=timeout)
+    r.raise_for_status()
+    return r.json()
+
+
+class PooledAPIWrapper(api.APIWrapper):
+    """`api.APIWrapper` that sends its authenticated requests over the pooled session
+    instead of opening a fresh `requests.Session()` per call.
+    """
+
+    def me(self) -> requests.Response:
+        return send(self._prep_me())
+
+    def make_bet(self, amount: float, contractId: str, outcome: str, limitProb: Optional[float] = None) -> requests.Response:
+        return send(self._prep_make_bet(amount, contractId, outcome, limitProb=limitProb))
+
+    def cancel_bet(self, bet_id: str) -> requests.Response:
+        return send(self._prep_cancel_bet(bet_id))
+
+    def sell_shares(self, market_id: str, outcome: str, shares: Optional[int] = None) -> requests.Response:
+        return send(self._prep_sell(market_id, outcome, shares))
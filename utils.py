@@ -1,9 +1,13 @@
 import datetime
+import inspect
 import math
 import pickle
 import string
 import sys
+import threading
 import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 from typing import *
 
@@ -13,13 +17,18 @@ import yaml
 from nltk.corpus import stopwords
 from nltk.stem import WordNetLemmatizer
 
+import transport
+from ledger import get_ledger
+from resolved import get_resolved_markets
 from manifoldpy import api
 
-RESOLVED_MARKETS = "data/resolved_markets.txt"
 CONFIG = "data/config.yaml"
 
 CACHE_EXPIRY_SCRAPING = 60 * 4  # 4 minutes
 CACHE_EXPIRY_MANIFOLD = 60 * 1
+CACHE_EXPIRY_PAGES = 60 * 15  # on-disk page cache, revalidated with the server after this
+MANIFOLD_MAX_WORKERS = 8  # concurrent requests to the Manifold API
+BETS_FIRST_PAGE = 50  # first page size of incremental bet fetches (doubled up to 1000 while every bet is new)
 
 MarketId = NewType("MarketId", str)
 GroupName = NewType("GroupName", str)
@@ -28,36 +37,150 @@ IsComplementary = NewType("mkt_outcome_is_complementary", bool)
 # GroupEntry = Tuple[GroupName, List[MarketId, IsComplementary]]]
 
 
-def cache_with_expiry(seconds, verbose=False):
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "evictions", "maxsize", "currsize"])
+
+
+class TTLCache:
+    """Thread-safe cache with a maximum size where every entry expires after `seconds`.
+    When full, expired entries are evicted first, then the least recently used ones.
+    """
+
+    def __init__(self, seconds, maxsize=128):
+        assert maxsize is None or maxsize > 0, "maxsize must be positive (or None for unbounded)."
+        self.seconds = seconds
+        self.maxsize = maxsize
+        self._entries = OrderedDict()  # key -> (time of storing, value), least recently used first
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries and not self._is_expired(self._entries[key][0])
+
+    def _is_expired(self, stored_at):
+        return time.time() - stored_at >= self.seconds
+
+    def get(self, key, default=None):
+        """Returns the cached value for `key` (and marks it as recently used) or `default` if missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or self._is_expired(entry[0]):
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            return default if entry is None else entry[1]
+
+    def _evict(self):
+        """Drops expired entries once the cache is full, then the least recently used ones."""
+        if self.maxsize is None or len(self._entries) <= self.maxsize:
+            return
+        expired = [k for k, (stored_at, _) in self._entries.items() if self._is_expired(stored_at)]
+        for k in expired:
+            del self._entries[k]
+        self.evictions += len(expired)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def info(self) -> CacheInfo:
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.evictions, self.maxsize, len(self._entries))
+
+
+_MISSING = object()
+
+
+def cache_with_expiry(seconds, maxsize=128, normalize_args=False, verbose=False):
+    """Caches the results of a function for `seconds` in a bounded, thread-safe `TTLCache`.
+
+    `normalize_args`: bind the call to the function's signature (incl. defaults) before building the key,
+    so that `f(1)`, `f(x=1)` and `f(1, y=<default>)` share one cache entry.
+
+    The decorated function exposes `cache_info()`, `cache_clear()` and the underlying `cache`.
+    """
+
     def decorator(func):
-        cache = {}  # (input to func) -> (time of calling, result of calling)
+        cache = TTLCache(seconds=seconds, maxsize=maxsize)  # (input to func) -> (time of calling, result of calling)
+        signature = inspect.signature(func) if normalize_args else None
+
+        def make_key(args, kwargs):
+            if signature is not None:
+                bound = signature.bind(*args, **kwargs)
+                bound.apply_defaults()
+                return tuple(bound.arguments.items())
+            return (args, tuple(kwargs.items()))
 
         @wraps(func)
         def wrapper(*args, **kwargs):
             # Check if the result is already in the cache and has not expired
-            key = (args, tuple(kwargs.items()))
-            if key in cache and time.time() - cache[key][0] < seconds:
+            key = make_key(args, kwargs)
+            result = cache.get(key, _MISSING)
+            if result is not _MISSING:
                 if verbose:
-                    func_name = func.__name__
-                    print(f"Cache hit for {func_name}({key}), use cached result.")
-                return cache[key][1]
+                    print(f"Cache hit for {func.__name__}({key}), use cached result.")
+                return result
 
             # Otherwise, call the function and cache the result
             if verbose:
-                func_name = func.__name__
-                print(f"Cache miss for {func_name}({key}), recompute result.")
+                print(f"Cache miss for {func.__name__}({key}), recompute result.")
             result = func(*args, **kwargs)
-            cache[key] = (time.time(), result)
+            cache.set(key, result)
             return result
 
+        wrapper.cache = cache
+        wrapper.cache_info = cache.info
+        wrapper.cache_clear = cache.clear
         return wrapper
 
     return decorator
 
 
-@cache_with_expiry(seconds=CACHE_EXPIRY_MANIFOLD, verbose=False)
+@cache_with_expiry(seconds=CACHE_EXPIRY_MANIFOLD, maxsize=1024, normalize_args=True, verbose=False)
 def get_market_from_manifold(mkt_id: MarketId) -> api.Market:
-    return api.get_market(mkt_id)
+    return api.Market.from_json(transport.get_json(api.SINGLE_MARKET_URL.format(mkt_id)))
+
+
+def get_markets_bulk(mkt_ids: Iterable[MarketId], max_workers=MANIFOLD_MAX_WORKERS, verbose=False) -> Dict[MarketId, api.Market]:
+    """Fetches many markets concurrently (deduplicated, through the cache of `get_market_from_manifold`).
+    Markets that can't be fetched are left out of the result; the caller will retry them one by one.
+    """
+    unique_ids = list(dict.fromkeys(mkt_ids))
+
+    def fetch(mkt_id):
+        try:
+            return get_market_from_manifold(mkt_id)
+        except Exception as e:
+            print(f"Error fetching market {mkt_id}: {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(unique_ids)))) as executor:
+        markets = dict(zip(unique_ids, executor.map(fetch, unique_ids)))
+    if verbose:
+        print(f"Fetched {len(unique_ids)} markets ({get_market_from_manifold.cache_info()}).")
+    return {mkt_id: mkt for mkt_id, mkt in markets.items() if mkt is not None}
 
 
 def sort_by_attribute(iterable, attr_name):
@@ -89,17 +212,12 @@ def load_config(username="howtodowtle"):
     return api_key, user_id
 
 
-def read_resolved_markets():
-    """Read which market ids are already resolved from file."""
-    with open(RESOLVED_MARKETS, "r") as f:
-        resolved_markets = f.read().splitlines()
-    return resolved_markets
-
-
-def append_resolved_market(mkt_id):
-    """Append a market id to the file of resolved markets."""
-    with open(RESOLVED_MARKETS, "a") as f:
-        f.write(f"{mkt_id}\n")
+def append_resolved_market(mkt_id, close_time=None, resolution_time=None):
+    """Record a market id (with its close/resolution time, if known) in the store of resolved markets."""
+    get_resolved_markets().add(mkt_id, close_time=close_time, resolution_time=resolution_time)
+    with _group_indexes_lock:
+        for index in _group_indexes.values():
+            index.mark_resolved(mkt_id)
 
 
 def pickle_something(obj, filename):
@@ -132,7 +250,7 @@ def filter_question(question, q_filter):
 
 
 def get_balance():
-    user = api.get_user_by_name("howtodowtle")
+    user = api.weak_structure(transport.get_json(api.USERNAME_URL.format("howtodowtle")), api.User)
     return user.balance
 
 
@@ -179,17 +297,104 @@ def get_group_shares(mkt_id, individual_mkt_shares, database, user_id, verbose=F
     return group_shares
 
 
+class GroupIndex:
+    """Index of the market groups of a database: group name -> markets with that outcome and markets with the
+    complementary ("!"-prefixed) outcome. Built on first use and rebuilt whenever the groups of the database change.
+    """
+
+    def __init__(self, database, resolved_markets=()):
+        self._database = database
+        self._groups: Dict[str, List[Tuple[str, bool]]] = {}  # group name without "!" -> [(mkt_id, is_complementary), ...]
+        self._market_groups: Dict[str, Optional[str]] = {}
+        self._resolved = set(resolved_markets)
+        self._lock = threading.RLock()
+        self._build({mkt_id: mkt_dict["group"] for mkt_id, mkt_dict in database.items()})
+
+    def _build(self, market_groups):
+        with self._lock:
+            self._groups, self._market_groups = {}, {}
+            for mkt_id, group in market_groups.items():
+                self.add(mkt_id, group)
+
+    def add(self, mkt_id, group):
+        """Adds a market (or moves it to another group)."""
+        with self._lock:
+            if mkt_id in self._market_groups:
+                self.remove(mkt_id)
+            self._market_groups[mkt_id] = group
+            if group is not None:
+                self._groups.setdefault(group.lstrip("!"), []).append((mkt_id, group.startswith("!")))
+
+    def remove(self, mkt_id):
+        with self._lock:
+            group = self._market_groups.pop(mkt_id, None)
+            if group is not None:
+                members = self._groups[group.lstrip("!")]
+                members.remove((mkt_id, group.startswith("!")))
+                if not members:
+                    del self._groups[group.lstrip("!")]
+
+    def mark_resolved(self, mkt_id):
+        with self._lock:
+            self._resolved.add(mkt_id)
+
+    def sync(self):
+        """Picks up markets added to, removed from or moved to another group in the database since the index was built."""
+        market_groups = {mkt_id: mkt_dict["group"] for mkt_id, mkt_dict in self._database.items()}
+        with self._lock:
+            if market_groups != self._market_groups:
+                self._build(market_groups)  # rare, and keeps the members in database order
+
+    def group_names(self) -> List[str]:
+        """All group names (without "!")."""
+        with self._lock:
+            return list(self._groups)
+
+    def members(self, group, include_resolved=True) -> List[Tuple[str, bool]]:
+        """All markets of a group (with or without "!") as (mkt_id, is_complementary) in database order,
+        where is_complementary refers to the "!"-prefixed outcome.
+        """
+        with self._lock:
+            members = list(self._groups.get(group.lstrip("!"), []))
+            if not include_resolved:
+                members = [(mid, compl) for mid, compl in members if mid not in self._resolved]
+        return members
+
+    def find(self, mkt_id, include_resolved=True) -> Tuple[List[str], List[str]]:
+        """Returns the markets with the same and with the opposite outcome as the given market (incl. itself)."""
+        with self._lock:
+            group = self._market_groups.get(mkt_id)
+            if group is None:
+                return [], []
+            members = self.members(group, include_resolved=include_resolved)
+        is_complementary = group.startswith("!")
+        same_outcome_mkts = [mid for mid, compl in members if compl == is_complementary]
+        opposite_outcome_mkts = [mid for mid, compl in members if compl != is_complementary]
+        return same_outcome_mkts, opposite_outcome_mkts
+
+
+_group_indexes: Dict[int, GroupIndex] = {}
+_group_indexes_lock = threading.Lock()
+
+
+def get_group_index(database) -> GroupIndex:
+    """Returns the group index of a database (`DB`, `IDENTICAL_MARKETS`), building it on first use.
+    Keyed by `id` because the databases are dicts (neither hashable nor weak-referenceable); the index holds
+    its database, so the id can't be reused for another object while the entry exists.
+    """
+    with _group_indexes_lock:
+        index = _group_indexes.get(id(database))
+        if index is None or index._database is not database:
+            index = _group_indexes[id(database)] = GroupIndex(database, get_resolved_markets())
+    index.sync()
+    return index
+
+
 def find_group(mkt_id, database, verbose=False) -> Tuple[List[str], List[str]]:
     """Returns all the markets in the same group as the given market."""
     if verbose:
         print(f"Finding group for market {mkt_id}...")
-    group = database[mkt_id]["group"]
-    if group.startswith("!"):
-        same_outcome_mkts = [mid for mid in database if database[mid]["group"] == group]
-        opposite_outcome_mkts = [mid for mid in database if database[mid]["group"] == group[1:]]
-    else:
-        same_outcome_mkts = [mid for mid in database if database[mid]["group"] == group]
-        opposite_outcome_mkts = [mid for mid in database if database[mid]["group"] == "!" + group]
+    same_outcome_mkts, opposite_outcome_mkts = get_group_index(database).find(mkt_id)
     if verbose:
         print(f"Markets with same outcome: {[api.get_market(mid).question for mid in same_outcome_mkts]}")
         print(f"Markets with opposite outcome: {[api.get_market(mid).question for mid in opposite_outcome_mkts]}")
@@ -252,6 +457,19 @@ def minimal_question(question, max_length=44):
     return further_compressed
 
 
+def _get_bets_page(
+    userId: Optional[str] = None,
+    username: Optional[str] = None,
+    marketId: Optional[str] = None,
+    marketSlug: Optional[str] = None,
+    limit: Optional[int] = 1000,
+    before: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    """Same as `api._get_bets` (at most 1000 bets) but over the pooled transport."""
+    params = {"userId": userId, "username": username, "contractId": marketId, "contractSlug": marketSlug, "limit": limit, "before": before}
+    return transport.get_json(api.BETS_URL, params={k: v for k, v in params.items() if v is not None})
+
+
 def _get_all_bets_custom(
     username: Optional[str] = None,
     userId: Optional[str] = None,
@@ -261,16 +479,20 @@ def _get_all_bets_custom(
     limit: int = sys.maxsize,
     before_id: Optional[str] = None,
 ) -> List[Dict[str, Any]]:
-    """Underlying API call for `get_all_bets`."""
+    """Underlying API call for `get_all_bets`.
+    The API has no `after` cursor (bets come newest first), so with `after` the pages start small and grow
+    while all their bets are new: a sync with few new bets doesn't download a full page of 1000.
+    """
     bets: List[Dict[str, Any]] = []
     i = before_id
+    page_size = BETS_FIRST_PAGE if after > 0 else 1000
     while True:
-        num_to_get = min(limit - len(bets), 1000)
+        num_to_get = min(limit - len(bets), page_size)
         if num_to_get <= 0:
             break
         new_bets = [
             b
-            for b in api._get_bets(
+            for b in _get_bets_page(
                 limit=num_to_get,
                 before=i,
                 username=username,
@@ -281,17 +503,18 @@ def _get_all_bets_custom(
             if b["createdTime"] > after
         ]
         bets.extend(new_bets)
-        if len(new_bets) < 1000:
+        if len(new_bets) < num_to_get:
             break
         else:
             i = bets[-1]["id"]
-    # TODO: Need a better way to determine equality of bets. `id` is not sufficient
-    # At least some bets have duplicate ids.
+            page_size = min(2 * page_size, 1000)
+    # NB: `id` is not sufficient to determine equality of bets, at least some bets have duplicate ids.
+    # The ledger (see `ledger.BetLedger`) therefore keys bets by (user, market, id, created time).
     # assert len(bets) == len({b.id for b in bets})
     return bets
 
 
-@cache_with_expiry(seconds=CACHE_EXPIRY_MANIFOLD, verbose=False)
+@cache_with_expiry(seconds=CACHE_EXPIRY_MANIFOLD, maxsize=1024, normalize_args=True, verbose=False)
 def get_user_bets_custom(
     user_id: Optional[str] = None,
     mkt_id: Optional[str] = None,
@@ -312,13 +535,13 @@ def get_user_bets_custom(
         limit: The maximum number of bets to retrieve.
         as_json: Whether to return the raw JSON response from the API.
     """
-    return [
-        api.weak_structure(x, api.Bet)
-        for x in _get_all_bets_custom(
-            userId=user_id,
-            marketId=mkt_id,
-        )
-    ]
+    ledger = get_ledger() if user_id is not None else None
+    if ledger is None:
+        bets = _get_all_bets_custom(userId=user_id, marketId=mkt_id)
+    else:  # only fetch the bets since the last sync, serve the rest from the local ledger
+        ledger.sync(user_id, lambda after, market: _get_all_bets_custom(userId=user_id, marketId=market, after=after), mkt_id=mkt_id)
+        bets = ledger.get_bets(user_id, mkt_id)
+    return [api.weak_structure(x, api.Bet) for x in bets]
 
 
 def should_bet_probabilities(mkt_p, true_p, margin, tail):
@@ -392,6 +615,18 @@ def limit_price_arb(lo_p, hi_p, round_to_digits=2, factor=(1 - 0.44)) -> float:
     return round(price, round_to_digits)
 
 
+def limit_price_consensus(ps, round_to_digits=2, factor=(1 - 0.44)) -> float:
+    """Generalizes `limit_price_arb` to any number of probabilities for the same outcome:
+    the means of the lower and the upper half of `ps` (an odd middle one counts for both) take the roles of `lo_p` and `hi_p`,
+    so that a single outlier doesn't drag the whole group. For two probabilities, this is `limit_price_arb(min(ps), max(ps))`.
+    """
+    ps = sorted(ps)
+    assert len(ps) >= 2, "Need at least two probabilities."
+    half = (len(ps) + 1) // 2
+    lo_p, hi_p = sum(ps[:half]) / half, sum(ps[-half:]) / half
+    return limit_price_arb(lo_p, hi_p, round_to_digits=round_to_digits, factor=factor)
+
+
 def limit_price_is_between_ps(mkt_p, true_p, limit_price) -> bool:
     if true_p < mkt_p:  # bet down
         return true_p < limit_price < mkt_p
@@ -414,11 +649,14 @@ def get_bed_id(response):
     return j.get("betId")
 
 
-def make_bet_and_cancel(wrapper, amount, contract_id, binary_outcome, limit_p, dry_run):
+def place_limit_order(wrapper, amount, contract_id, binary_outcome, limit_p, dry_run) -> Optional[Dict[str, Any]]:
+    """Places a limit order and cancels whatever isn't filled right away.
+    Returns the bet as filled (amount spent, shares, fills) or None if no bet was made.
+    """
     print(f"Betting {amount:4} M on {binary_outcome:3} at {limit_p*100:.1f} % (mkt {contract_id}).")
     if dry_run:
         print("Dry run (no bet made).")
-        return False
+        return None
     r = wrapper.make_bet(
         amount=amount,
         contractId=contract_id,
@@ -429,9 +667,27 @@ def make_bet_and_cancel(wrapper, amount, contract_id, binary_outcome, limit_p, d
         bid = get_bed_id(r)
         if bid is None:
             print(f"Bet on market {contract_id} failed.")
-            return False
+            return None
+        bet = r.json()
         r_ = wrapper.cancel_bet(bid)
+        if r_.status_code == 200:
+            try:
+                cancelled = r_.json()
+            except ValueError:
+                cancelled = None
+            if isinstance(cancelled, dict) and cancelled.get("amount") is not None:
+                bet = cancelled  # includes fills between placing and cancelling
         # print("Success.")
-        return True
+        return bet
     print("Failed.")
-    return False
+    return None
+
+
+def make_bet_and_cancel(wrapper, amount, contract_id, binary_outcome, limit_p, dry_run, account=None) -> bool:
+    """Places a limit order, cancels the rest and books the fill in `account` (an `account.Account`), if given."""
+    bet = place_limit_order(wrapper, amount, contract_id, binary_outcome, limit_p, dry_run)
+    if bet is None:
+        return False
+    if account is not None:
+        account.apply_bet(contract_id, binary_outcome, bet)
+    return True